@@ -0,0 +1,362 @@
+"""
+Blocked gzip (BGZF) reading and writing.
+
+BGZF files are a series of independently compressed gzip members of at most
+64KB each, so they stay readable by gzip/zcat but can be randomly accessed
+with 'virtual offsets' (block start << 16 | offset within block) and
+decompressed in parallel block by block. Writer also saves a bgzip
+compatible .gzi index of block offsets next to the file.
+"""
+
+import io
+import os
+import struct
+import zlib
+import queue
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+# keep uncompressed block small enough that compressed block always fits
+# in the 16 bit BSIZE field (same limit bgzip uses)
+MAX_BLOCK_SIZE = 0xff00
+
+HEADER = struct.Struct('<4BI2BH2BHH')
+HEADER_SIZE = HEADER.size
+FOOTER = struct.Struct('<II')
+
+# compressed blocks allowed in flight per compression thread
+BLOCKS_PER_THREAD = 4
+
+# default threads compressing blocks for BgzfWriter
+WRITER_THREADS = 2
+
+# empty block written at end of every BGZF file
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+INDEX_SUFFIX = '.gzi'
+
+
+def compress_block(data, level=6):
+    """ compress bytes (<= MAX_BLOCK_SIZE) into one complete BGZF block """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = HEADER_SIZE + len(deflated) + FOOTER.size
+    header = HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, block_size - 1)
+    footer = FOOTER.pack(zlib.crc32(data), len(data))
+    return header + deflated + footer
+
+
+def decompress_block(block):
+    """ decompress one complete BGZF block """
+    return zlib.decompress(block[HEADER_SIZE:-FOOTER.size], -15)
+
+
+def read_block_size(header):
+    """ get total block size from block header, None if not a BGZF block """
+    if len(header) < HEADER_SIZE:
+        return None
+    fields = HEADER.unpack(header[:HEADER_SIZE])
+    if fields[:4] != (31, 139, 8, 4) or fields[8:11] != (66, 67, 2):
+        return None
+    return fields[11] + 1
+
+
+def is_bgzf(file):
+    """ check if file starts with a BGZF block """
+    if os.path.isdir(file):
+        return False
+    with open(file, 'rb') as f:
+        return read_block_size(f.read(HEADER_SIZE)) != None
+
+
+def make_virtual_offset(block_start, within_block):
+    return (block_start << 16) | within_block
+
+
+def split_virtual_offset(virtual_offset):
+    return virtual_offset >> 16, virtual_offset & 0xffff
+
+
+def block_offsets(file):
+    """
+    list of (compressed, uncompressed) start offsets for every data block -
+    read from .gzi index if present, otherwise by hopping block headers
+    """
+    index_file = file + INDEX_SUFFIX
+    if os.path.exists(index_file):
+        with open(index_file, 'rb') as f:
+            count = struct.unpack('<Q', f.read(8))[0]
+            pairs = struct.unpack(f'<{count * 2}Q', f.read(count * 16))
+        offsets = [(0, 0)]
+        offsets.extend(zip(pairs[0::2], pairs[1::2]))
+        return offsets
+
+    offsets = []
+    uncompressed = 0
+    with open(file, 'rb') as f:
+        while True:
+            start = f.tell()
+            header = f.read(HEADER_SIZE)
+            block_size = read_block_size(header)
+            if block_size == None:
+                break
+            f.seek(start + block_size - 4)
+            data_size = struct.unpack('<I', f.read(4))[0]
+            if data_size > 0:
+                offsets.append((start, uncompressed))
+            uncompressed += data_size
+    return offsets
+
+
+class BgzfWriter(io.BufferedIOBase):
+    """
+    binary writer that emits BGZF blocks as data accumulates - with threads
+    > 1, blocks are compressed on a pool of background threads (zlib 
+    releases the GIL) and a writer thread writes them out in order as they
+    complete, so the caller only ever buffers data and hands off blocks.
+    threads=1 compresses and writes each block inline
+    """
+
+    def __init__(self, file, level=6, write_index=True, threads=WRITER_THREADS):
+        self.file = file
+        self.raw = open(file, 'wb')
+        self.level = level
+        self.write_index = write_index
+        self.buffer = bytearray()
+        self.offsets = []
+        self.compressed_offset = 0
+        self.uncompressed_offset = 0
+        self.pool = None
+        self.error = None
+        if threads > 1:
+            self.pool = ThreadPoolExecutor(threads)
+            # bounds memory held by queued blocks
+            self.queue = queue.Queue(threads * BLOCKS_PER_THREAD)
+            self.writer = threading.Thread(target=self._write_queued, daemon=True)
+            self.writer.start()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= MAX_BLOCK_SIZE:
+            self._write_block(bytes(self.buffer[:MAX_BLOCK_SIZE]))
+            del self.buffer[:MAX_BLOCK_SIZE]
+        return len(data)
+
+    def _write_block(self, data):
+        if self.pool == None:
+            self._write_compressed(compress_block(data, self.level), len(data))
+            return
+        self._check_writer()
+        self.queue.put((self.pool.submit(compress_block, data, self.level),
+                        len(data)))
+
+    def _write_queued(self):
+        """
+        writer thread - write queued blocks in order as they are compressed,
+        until None is queued. After a failure, blocks are only drained so 
+        the caller never blocks on a full queue
+        """
+        while True:
+            item = self.queue.get()
+            if item == None:
+                return
+            if self.error != None:
+                continue
+            future, data_size = item
+            try:
+                self._write_compressed(future.result(), data_size)
+            except Exception as e:
+                self.error = e
+
+    def _check_writer(self):
+        """ raise failure from writer thread in the caller """
+        if self.error != None:
+            raise self.error
+
+    def _write_compressed(self, block, data_size):
+        self.offsets.append((self.compressed_offset, self.uncompressed_offset))
+        self.raw.write(block)
+        self.compressed_offset += len(block)
+        self.uncompressed_offset += data_size
+
+    def _stop_writer(self):
+        """ let writer thread finish queued blocks, then stop threads """
+        if self.pool != None and self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+            self.pool.shutdown()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if len(self.buffer) > 0:
+                self._write_block(bytes(self.buffer))
+                self.buffer.clear()
+            self._stop_writer()
+            self._check_writer()
+            self.raw.write(EOF_BLOCK)
+        finally:
+            self._stop_writer()
+            self.raw.close()
+            super().close()
+        if self.write_index:
+            self._save_index()
+
+    def _save_index(self):
+        """ bgzip style .gzi: count, then offset pairs for blocks after first """
+        pairs = self.offsets[1:]
+        with open(self.file + INDEX_SUFFIX, 'wb') as f:
+            f.write(struct.pack('<Q', len(pairs)))
+            for compressed, uncompressed in pairs:
+                f.write(struct.pack('<QQ', compressed, uncompressed))
+
+
+class BgzfReader(io.BufferedIOBase):
+    """
+    binary reader over BGZF file - tell() and seek() work in virtual
+    offsets so any position can be reached by decompressing a single block
+    """
+
+    def __init__(self, file):
+        self.raw = open(file, 'rb')
+        self.block_start = 0
+        self.next_block_start = 0
+        self.data = b''
+        self.pos = 0
+        self._load_block(0)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _load_block(self, start):
+        """ read and decompress block at compressed offset start """
+        self.raw.seek(start)
+        header = self.raw.read(HEADER_SIZE)
+        block_size = read_block_size(header)
+        self.block_start = start
+        self.pos = 0
+        if block_size == None:
+            self.data = b''
+            self.next_block_start = start
+            return False
+        block = header + self.raw.read(block_size - HEADER_SIZE)
+        self.data = decompress_block(block)
+        self.next_block_start = start + block_size
+        return True
+
+    def _fill(self):
+        """ make sure there is unread data in current block, False at EOF """
+        while self.pos >= len(self.data):
+            if not self._load_block(self.next_block_start):
+                return False
+        return True
+
+    def tell(self):
+        if self.pos >= len(self.data):
+            return make_virtual_offset(self.next_block_start, 0)
+        return make_virtual_offset(self.block_start, self.pos)
+
+    def seek(self, virtual_offset, whence=io.SEEK_SET):
+        if whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('BGZF only supports absolute seeks')
+        block_start, within = split_virtual_offset(virtual_offset)
+        if block_start != self.block_start or len(self.data) == 0:
+            self._load_block(block_start)
+        self.pos = within
+        return virtual_offset
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0 and self._fill():
+            end = len(self.data) if size < 0 else min(len(self.data), self.pos + size)
+            chunks.append(self.data[self.pos:end])
+            if size > 0:
+                size -= end - self.pos
+            self.pos = end
+        return b''.join(chunks)
+
+    def read1(self, size=-1):
+        if not self._fill():
+            return b''
+        end = len(self.data) if size < 0 else min(len(self.data), self.pos + size)
+        chunk = self.data[self.pos:end]
+        self.pos = end
+        return chunk
+
+    def readline(self, size=-1):
+        chunks = []
+        while self._fill():
+            newline = self.data.find(b'\n', self.pos)
+            end = len(self.data) if newline < 0 else newline + 1
+            chunks.append(self.data[self.pos:end])
+            self.pos = end
+            if newline >= 0:
+                break
+        return b''.join(chunks)
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        super().close()
+
+
+class ParallelBgzfReader(BgzfReader):
+    """
+    sequential (no seek) reader over BGZF file that decompresses upcoming 
+    blocks on a pool of threads while the caller consumes the current one
+    """
+
+    def __init__(self, file, threads):
+        self.raw = open(file, 'rb')
+        self.pool = ThreadPoolExecutor(threads)
+        self.max_pending = threads * BLOCKS_PER_THREAD
+        self.pending = collections.deque()
+        self.eof = False
+        self.data = b''
+        self.pos = 0
+        self._queue_blocks()
+
+    def seekable(self):
+        return False
+
+    def _queue_blocks(self):
+        """ read compressed blocks ahead and queue them for decompression """
+        while not self.eof and len(self.pending) < self.max_pending:
+            header = self.raw.read(HEADER_SIZE)
+            block_size = read_block_size(header)
+            if block_size == None:
+                self.eof = True
+                break
+            block = header + self.raw.read(block_size - HEADER_SIZE)
+            self.pending.append(self.pool.submit(decompress_block, block))
+
+    def _fill(self):
+        while self.pos >= len(self.data):
+            if not self.pending:
+                return False
+            self.data = self.pending.popleft().result()
+            self.pos = 0
+            self._queue_blocks()
+        return True
+
+    def tell(self):
+        raise io.UnsupportedOperation('parallel BGZF reader is sequential only')
+
+    def seek(self, virtual_offset, whence=io.SEEK_SET):
+        raise io.UnsupportedOperation('parallel BGZF reader is sequential only')
+
+    def close(self):
+        if not self.closed:
+            # blocks nobody will read - cancel rather than wait for them
+            for future in self.pending:
+                future.cancel()
+            self.pool.shutdown()
+        super().close()
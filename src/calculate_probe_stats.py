@@ -1,8 +1,12 @@
 #! /usr/bin/env python3
 
-import statistics
 import argparse
+import multiprocessing
 import matrix_utils
+import matrix_index
+import matrix_store
+import probe_stats_utils as probe_stats
+import numpy as np
 import sys
 
 """
@@ -10,6 +14,19 @@ Read input .wide.tsv probes file with probes as columns and calculate
 descriptive statistics for each probe
 """
 
+# most parsed rows folded into running stats at once
+BLOCK_SIZE = 256
+
+# default memory budget (per process) for blocks of rows and the float64
+# temporaries folding them creates - about BLOCK_COPIES copies of a block
+MEMORY_MB = 256
+BLOCK_COPIES = 8
+
+# spawn keys for independent random streams derived from the run seed
+SHARD_STREAM = 0
+MERGE_STREAM = 1
+UPDATE_STREAM = 2
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='gather descriptive statistics' +
@@ -28,45 +45,258 @@ def parse_args():
                         help='placeholder value to use for missing probe vals [default=-1]')
     
     parser.add_argument('-x', '--max_probes', type=float, default=25000,
-                        help='number of probes to process at once [default=25k]')
+                        help='deprecated and ignored - all probes are ' +
+                        'processed in a single pass')
+
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of processes to split input rows ' +
+                        'across [default=1]')
+
+    parser.add_argument('-q', '--quantiles', type=parse_quantiles,
+                        help='comma separated quantiles (0-1) to estimate ' +
+                        'per probe, e.g. 0.25,0.5,0.75')
+
+    parser.add_argument('-k', '--sketch_k', type=int, default=128,
+                        help='quantile sketch size - rank error is about ' +
+                        '2.3/k^0.97 (2.1%% at default) [default=128]')
+
+    parser.add_argument('--seed', type=int,
+                        help='random seed for quantile sketch - estimates ' +
+                        'are identical for a given seed and number of ' +
+                        'workers [default=random, logged]')
+
+    parser.add_argument('--memory_mb', type=int, default=MEMORY_MB,
+                        help='memory budget per process for blocks of rows ' +
+                        'in MB - wide inputs are folded in fewer rows at ' +
+                        f'a time [default={MEMORY_MB}]')
+
+    parser.add_argument('-u', '--update', type=str,
+                        help='existing stats output to fold input rows into ' +
+                        '(reads accumulators saved in <file>.state, or the ' +
+                        '.state file itself)')
+
+    parser.add_argument('-s', '--state', type=str,
+                        help='file to save accumulators to for later ' +
+                        '--update [default=<output>.state, none if writing ' +
+                        'to STDOUT]')
 
         
     args = parser.parse_args()
     return args
 
+def parse_quantiles(text):
+    """ comma separated quantiles, each between 0 and 1 """
+    try:
+        quantiles = [float(q) for q in text.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('quantiles must be comma separated ' +
+                                         'numbers: ' + text)
+    for q in quantiles:
+        if not 0 <= q <= 1:
+            raise argparse.ArgumentTypeError(f'quantile {q:g} is not between ' +
+                                             '0 and 1')
+    return quantiles
+
 def read_header(in_file, probe_start_idx):
 
     print(f'reading header from {in_file}...', file=sys.stderr)
     probe_idxs = {}
-    f = matrix_utils.open_file(in_file)
-    for line in f:
-        fields = line.rstrip().split('\t')
-        for i in range(probe_start_idx, len(fields)):
-            probe_idxs[fields[i]] = i
-        break
-    f.close()
+    if matrix_store.is_store(in_file):
+        fields = matrix_store.MatrixStore(in_file).header
+    else:
+        f = matrix_utils.open_file(in_file)
+        fields = f.readline().rstrip().split('\t')
+        f.close()
+    for i in range(probe_start_idx, len(fields)):
+        probe_idxs[fields[i]] = i
     return probe_idxs    
 
-def split_probes(probe_idxs, chunk_size):
-    probe_chunks = []
-    current_chunk = {}
-    for probe, _ in probe_idxs.items():
-        if len(current_chunk) == chunk_size:
-            probe_chunks.append(current_chunk)
-            current_chunk = {}
-        current_chunk[probe] = []
-    probe_chunks.append(current_chunk)
-    return probe_chunks
-            
+def accumulate_stats(in_file, num_probes, probe_start_idx, missing_val,
+                     sketch_k=None, seed=None, block_size=BLOCK_SIZE):
+    """
+    stream rows of input once, folding blocks of parsed rows into running
+    per-probe stats
+    """
+    if matrix_store.is_store(in_file):
+        store = matrix_store.MatrixStore(in_file)
+        return accumulate_store_rows(store, 0, len(store), missing_val,
+                                     sketch_k=sketch_k, seed=seed,
+                                     block_size=block_size)
+
+    f = matrix_utils.open_file(in_file, threads=matrix_utils.DECOMPRESS_THREADS)
+    # read past header
+    f.readline()
+    stats = accumulate_lines(f, num_probes, probe_start_idx, missing_val,
+                             sketch_k=sketch_k, seed=seed,
+                             block_size=block_size)
+    f.close()
+    return stats
+
+def accumulate_lines(lines, num_probes, probe_start_idx, missing_val,
+                     sketch_k=None, seed=None, block_size=BLOCK_SIZE):
+    """ fold text lines (no header) into new set of running stats """
+    stats = probe_stats.ProbeStats(num_probes, sketch_k=sketch_k, seed=seed)
+    block = []
+    counter = 0
+    for line in lines:
+        if line.strip() == '':
+            continue
+        fields = line.rstrip('\n').split('\t')
+        block.append(matrix_utils.parse_probe_vals(fields[probe_start_idx:]))
+        counter += 1
+        if len(block) == block_size:
+            update_stats(stats, np.vstack(block), missing_val)
+            block = []
+            print(f'{counter} lines read', file=sys.stderr)
+    if len(block) > 0:
+        update_stats(stats, np.vstack(block), missing_val)
+    return stats
+
+def accumulate_store_rows(store, start, end, missing_val, sketch_k=None, 
+                          seed=None, block_size=BLOCK_SIZE):
+    """ fold rows [start, end) of binary store into new running stats """
+    stats = probe_stats.ProbeStats(len(store.probes), sketch_k=sketch_k,
+                                   seed=seed)
+    for i in range(start, end, block_size):
+        block = store.text_vals(i, min(end, i + block_size))
+        update_stats(stats, block, missing_val)
+    return stats
+
+def block_rows(num_probes, memory_mb=MEMORY_MB):
+    """ rows per block so a block and its float64 temporaries fit budget """
+    row_bytes = BLOCK_COPIES * np.dtype(np.float64).itemsize * max(1, num_probes)
+    return max(1, min(BLOCK_SIZE, memory_mb * 1024 * 1024 // row_bytes))
+
+def sketch_seed(seed, *key):
+    """ independent, reproducible random stream for key under run seed """
+    return np.random.SeedSequence(seed, spawn_key=key)
+
+def accumulate_shard(in_file, shard, num_probes, probe_start_idx, missing_val,
+                     sketch_k, seed, block_size):
+    """ worker entry point - gather partial stats for one shard of rows """
+    start, end = shard
+    if matrix_store.is_store(in_file):
+        store = matrix_store.MatrixStore(in_file)
+        return accumulate_store_rows(store, start, end, missing_val, 
+                                     sketch_k=sketch_k, seed=seed,
+                                     block_size=block_size)
+    lines = matrix_index.read_shard(in_file, start, end)
+    return accumulate_lines(lines, num_probes, probe_start_idx, missing_val,
+                            sketch_k=sketch_k, seed=seed, block_size=block_size)
+
+def plan_shards(in_file, workers):
+    """ split input rows into one shard per worker where possible """
+    if matrix_store.is_store(in_file):
+        num_rows = len(matrix_store.MatrixStore(in_file))
+        bounds = [(num_rows * i) // workers for i in range(workers + 1)]
+        return [(bounds[i], bounds[i + 1]) for i in range(workers) 
+                if bounds[i] < bounds[i + 1]]
+    return matrix_index.row_shards(in_file, workers)
+
+def accumulate_parallel(in_file, num_probes, probe_start_idx, missing_val, 
+                        workers, sketch_k=None, seed=None, 
+                        block_size=BLOCK_SIZE):
+    """
+    gather partial stats for row shards in separate processes and merge
+    them - moments merge exactly so they match a single pass over the file.
+    Shard i's sketch draws from stream (seed, i) so estimates are the same
+    for a given seed and number of shards
+    """
+    shards = plan_shards(in_file, workers)
+    print(f'{len(shards)} row shards created', file=sys.stderr)
+    if len(shards) < workers:
+        print('input could not be split evenly - use BGZF or plain text ' +
+              'input to use all workers', file=sys.stderr)
+    if len(shards) == 1:
+        return accumulate_stats(in_file, num_probes, probe_start_idx,
+                                missing_val, sketch_k=sketch_k,
+                                seed=sketch_seed(seed, SHARD_STREAM, 0),
+                                block_size=block_size)
+
+    jobs = [(in_file, shard, num_probes, probe_start_idx, missing_val, sketch_k,
+             sketch_seed(seed, SHARD_STREAM, i), block_size) 
+            for i, shard in enumerate(shards)]
+    with multiprocessing.Pool(min(workers, len(jobs))) as pool:
+        partials = pool.starmap(accumulate_shard, jobs)
+
+    stats = probe_stats.ProbeStats(num_probes, sketch_k=sketch_k,
+                                   seed=sketch_seed(seed, MERGE_STREAM))
+    for partial in partials:
+        stats.merge(partial)
+    return stats
+
+def update_stats(stats, block, missing_val):
+    """
+    record missing vals in block and sub in placeholder val (if non-zero) 
+    before folding block into running stats
+    """
+    missing = np.isnan(block)
+    stats.add_missing(missing.sum(axis=0))
+    if missing_val:
+        block[missing] = missing_val
+    stats.update(block)
+
+def write_stats(probes, stats, output, quantiles=None):
+    """ print one line of stats per probe in input column order """
+    moments = stats.moments
+    header = ['probe','min','max','mean','stdev','missing']
+    seen = moments.count > 0
+    columns = [np.where(seen, moments.minimum, np.nan).tolist(),
+               np.where(seen, moments.maximum, np.nan).tolist(),
+               np.where(seen, moments.mean, np.nan).tolist(),
+               # a single val has no spread - 0 keeps noise models finite
+               np.where(moments.count > 1, moments.stdev(), 0.0).tolist(),
+               moments.missing.tolist()]
+    if quantiles:
+        header.extend([f'q{q:g}' for q in quantiles])
+        # sketch keeps float32 items - print at that precision
+        estimates = stats.sketch.quantiles(quantiles).astype(np.float32)
+        columns.extend([list(est) for est in estimates])
+
+    print('\t'.join(header), file=output)
+    for i, probe in enumerate(probes):
+        printvals = [probe] + [str(col[i]) for col in columns]
+        print('\t'.join(printvals), file=output)
+
+def load_previous_stats(stats_file, missing_val, quantiles, seed=None):
+    """
+    load accumulators saved with earlier stats output and make sure new rows
+    will be gathered the same way
+    """
+    state_file = stats_file
+    if not stats_file.endswith(probe_stats.STATE_SUFFIX):
+        state_file = probe_stats.state_path(stats_file)
+    print(f'loading saved stats from {state_file}', file=sys.stderr)
+    probes, stats, settings = probe_stats.load_state(state_file, seed=seed)
+    if settings['missing_val'] != missing_val:
+        raise Exception(f"missing val {missing_val} does not match saved " +
+                        f"stats: {settings['missing_val']}")
+    if quantiles != None and quantiles != settings['quantiles']:
+        raise Exception(f"quantiles {quantiles} do not match saved stats: " +
+                        f"{settings['quantiles']}")
+    print(f'{stats.moments.count.max()} rows in saved stats', file=sys.stderr)
+    return probes, stats, settings
+
+def merge_previous_stats(previous, probes, stats):
+    """
+    line up stats for new rows with saved probe order and fold them into
+    saved stats
+    """
+    prev_probes, prev_stats, _ = previous
+    if set(probes) != set(prev_probes):
+        raise Exception('probes in input do not match saved stats - ' +
+                        'rerun stats over full input')
+    probe_order = {probe: i for i, probe in enumerate(probes)}
+    stats.reorder([probe_order[probe] for probe in prev_probes])
+    prev_stats.merge(stats)
+    return prev_probes, prev_stats
 
 def main():
     """
-	Read input file and save values from each row for each probe. After reading
-	file, calculate statistics and print.
-	
-	This script reads all rows for target probe set and temporarily stores
-	values in memory - full 450k requires > 16GB RAM - by default, file 
-	is processed repeatedly in chunks of 25k.
+	Read input file once and keep running statistics for every probe at the 
+	same time. Memory use is a handful of arrays the length of the probe 
+	list (plus a fixed size quantile sketch per probe if requested) no matter
+	how many samples are in the input.
     """
 
     args  = parse_args()
@@ -74,53 +304,70 @@ def main():
     probe_idxs = read_header(args.input, args.probe_start_idx)
     print(f'{len(probe_idxs)} probe indexes loaded', file=sys.stderr)
 
+    quantiles = None
+    sketch_k = None
+    if args.quantiles:
+        quantiles = args.quantiles
+        sketch_k = args.sketch_k
+
+    seed = args.seed
+    if seed == None:
+        seed = np.random.SeedSequence().entropy
+    if quantiles or args.update:
+        print(f'random seed: {seed}', file=sys.stderr)
+
+    previous = None
+    if args.update:
+        previous = load_previous_stats(args.update, args.missing_val, quantiles,
+                                       seed=sketch_seed(seed, UPDATE_STREAM))
+        _, prev_stats, prev_settings = previous
+        quantiles = prev_settings['quantiles']
+        if prev_stats.sketch != None:
+            sketch_k = prev_stats.sketch.k
+
+    if quantiles:
+        print(f'estimating quantiles {quantiles} with sketch size {sketch_k}', 
+              file=sys.stderr)
+
     output = sys.stdout
     if args.output:
         output = matrix_utils.open_output_file(args.output)
 
-    
-    # read probes in multiple passes over file to handle a memory friendly
-    # amount of data each time
-    probe_chunks = split_probes(probe_idxs, args.max_probes)
-    print(f'{len(probe_chunks)} probe splits created', file=sys.stderr)
-    chunk_counter = 1
-    for probe_vals in probe_chunks :
-        print(f'reading probe chunk {chunk_counter} from {args.input}...', 
-              file=sys.stderr)
-        
-        chunk_counter += 1
-        
-        f = matrix_utils.open_file(args.input)
-        # read past header
-        f.readline()
-        
-        for line in f:
-            fields = line.rstrip().split('\t')
-            
-            for probe in probe_vals.keys():
-                probe_idx = probe_idxs[probe]
-                probe_val = None
-                try:
-                    probe_val = float(fields[probe_idx])
-                    probe_vals[probe].append(probe_val)
-                except ValueError:
-                    if args.missing_val:
-                        probe_vals[probe].append(args.missing_val)
-        f.close()
+    block_size = block_rows(len(probe_idxs), args.memory_mb)
+    print(f'reading probe values from {args.input} in blocks of ' +
+          f'{block_size} rows...', file=sys.stderr)
+    if args.workers > 1:
+        stats = accumulate_parallel(args.input, len(probe_idxs),
+                                    args.probe_start_idx, args.missing_val,
+                                    args.workers, sketch_k=sketch_k, seed=seed,
+                                    block_size=block_size)
+    else:
+        stats = accumulate_stats(args.input, len(probe_idxs), 
+                                 args.probe_start_idx, args.missing_val,
+                                 sketch_k=sketch_k,
+                                 seed=sketch_seed(seed, SHARD_STREAM, 0),
+                                 block_size=block_size)
                             
-        print(f'calculating stats and writing to output...', file=sys.stderr)
-    
-        print('\t'.join(['probe','min','max','mean','stdev']), file=output)
-        for probe, vals in probe_vals.items():
-            minimum = min(vals)
-            maximum = max(vals)
-            mean = statistics.mean(vals)
-            stdev = statistics.stdev(vals)
-            printvals = [probe,str(minimum),str(maximum),str(mean),str(stdev)]
-            print('\t'.join(printvals), file=output)
-        # free up mem
-        probe_vals.clear()
+    probes = list(probe_idxs.keys())
+    if previous != None:
+        probes, stats = merge_previous_stats(previous, probes, stats)
+
+    print(f'calculating stats and writing to output...', file=sys.stderr)
+    write_stats(probes, stats, output, quantiles=quantiles)
     output.close()
+
+    # keep accumulators so stats can be updated with new rows later
+    state_file = args.state
+    if state_file == None and args.output:
+        state_file = probe_stats.state_path(args.output)
+    if state_file != None:
+        settings = {'missing_val': args.missing_val, 'quantiles': quantiles,
+                    'seed': seed}
+        probe_stats.save_state(state_file, probes, stats, settings)
+        print(f'accumulators saved to {state_file}', file=sys.stderr)
+    else:
+        print('writing to STDOUT - accumulators not saved, use -s to keep ' +
+              'them for --update', file=sys.stderr)
     print('completed', file=sys.stderr)
 
 if __name__ == "__main__":
@@ -0,0 +1,178 @@
+"""
+Utilities for working with k-combinations of samples by index - counting,
+jumping straight to the combination at a given rank and iterating from
+there - so combination space can be split up without enumerating it
+"""
+
+import math
+
+
+def count_combinations(n, k, with_replacement=False):
+    """ number of k-combinations (multisets if with_replacement) of n items """
+    if with_replacement:
+        return math.comb(n + k - 1, k)
+    return math.comb(n, k)
+
+
+def unrank_combination(n, k, rank):
+    """
+    get combination at position rank in lexicographic order (the order
+    itertools.combinations produces) without enumerating earlier ones
+    """
+    combination = []
+    item = 0
+    for i in range(k):
+        # skip over blocks of combinations that start with smaller items
+        while True:
+            block = math.comb(n - item - 1, k - i - 1)
+            if rank < block:
+                break
+            rank -= block
+            item += 1
+        combination.append(item)
+        item += 1
+    return combination
+
+
+def next_combination(combination, n):
+    """ advance combination to its lexicographic successor in place """
+    k = len(combination)
+    i = k - 1
+    while i >= 0 and combination[i] == n - k + i:
+        i -= 1
+    if i < 0:
+        return False
+    combination[i] += 1
+    for j in range(i + 1, k):
+        combination[j] = combination[j - 1] + 1
+    return True
+
+
+def iter_combinations(n, k, with_replacement=False, start=0, count=None):
+    """
+    yield combinations (as tuples of item indexes) in itertools order
+    beginning at rank start - combinations with replacement are walked as
+    plain combinations of n + k - 1 items and shifted back down
+    """
+    if with_replacement:
+        space = n + k - 1
+    else:
+        space = n
+    if start >= math.comb(space, k):
+        return
+    combination = unrank_combination(space, k, start)
+    produced = 0
+    while count == None or produced < count:
+        if with_replacement:
+            yield tuple(item - i for i, item in enumerate(combination))
+        else:
+            yield tuple(combination)
+        produced += 1
+        if not next_combination(combination, space):
+            break
+
+
+def random_combination(n, k, rng, with_replacement=False):
+    """
+    draw one k-combination uniformly at random in O(k) using Floyd's
+    algorithm - multisets are drawn as combinations of n + k - 1 items and
+    shifted down, which keeps them uniform over all multisets
+    """
+    space = n + k - 1 if with_replacement else n
+    chosen = set()
+    for j in range(space - k, space):
+        item = int(rng.integers(j + 1))
+        chosen.add(j if item in chosen else item)
+    combination = sorted(chosen)
+    if with_replacement:
+        return tuple(item - i for i, item in enumerate(combination))
+    return tuple(combination)
+
+
+def sample_combinations(n, k, num, rng, with_replacement=False, unique=False):
+    """
+    draw num uniformly random k-combinations in O(num * k) without walking
+    combination space - if unique, no combination is drawn twice
+    """
+    if unique and num > count_combinations(n, k, with_replacement):
+        raise Exception(f'cannot draw {num} unique combinations of {k} ' +
+                        f'from {n} samples')
+    combinations = []
+    seen = set()
+    while len(combinations) < num:
+        combination = random_combination(n, k, rng, with_replacement)
+        if unique:
+            if combination in seen:
+                continue
+            seen.add(combination)
+        combinations.append(combination)
+    return combinations
+
+
+def unrank_revolving_door(n, k, rank):
+    """
+    get combination at position rank in revolving door order, defined
+    recursively as R(n, k) = R(n-1, k) followed by reversed R(n-1, k-1) 
+    with item n-1 added - consecutive combinations differ by swapping
+    exactly one item
+    """
+    combination = []
+    while k > 0:
+        if n == k:
+            combination.extend(range(n))
+            break
+        block = math.comb(n - 1, k)
+        if rank >= block:
+            # second half runs through R(n-1, k-1) backwards
+            combination.append(n - 1)
+            rank = math.comb(n - 1, k - 1) - 1 - (rank - block)
+            k -= 1
+        n -= 1
+    return sorted(combination)
+
+
+def next_revolving_door(combination, n):
+    """
+    advance combination to its revolving door successor in place (Kreher &
+    Stinson, algorithm 2.13, shifted to zero based items)
+    """
+    k = len(combination)
+    t = [0] + [item + 1 for item in combination] + [n + 1]
+    j = 1
+    while j <= k and t[j] == j:
+        j += 1
+    if (k - j) % 2 != 0:
+        if j == 1:
+            t[1] -= 1
+        else:
+            t[j - 1] = j
+            if j > 2:
+                t[j - 2] = j - 1
+    elif t[j + 1] != t[j] + 1:
+        t[j - 1] = t[j]
+        t[j] += 1
+    else:
+        t[j + 1] = t[j]
+        t[j] = j
+    combination[:] = [item - 1 for item in t[1:k + 1]]
+
+
+def iter_revolving_door(n, k, start=0, count=None):
+    """
+    yield (combination, removed, added) in revolving door order beginning at
+    rank start - removed/added are the single items swapped relative to the
+    previous combination (None for the first one yielded)
+    """
+    total = math.comb(n, k)
+    if count == None:
+        count = total - start
+    count = min(count, total - start)
+    combination = unrank_revolving_door(n, k, start)
+    removed = added = None
+    for i in range(count):
+        yield tuple(combination), removed, added
+        if i + 1 < count:
+            previous = set(combination)
+            next_revolving_door(combination, n)
+            removed, = previous.difference(combination)
+            added, = set(combination).difference(previous)
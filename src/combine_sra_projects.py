@@ -3,12 +3,34 @@
 """ 
 combine list of methyl 'wide' files into one and ensure that all probe vals are
 in the same column order for each sample
+
+output has the union of the probes in all files (or the requested probes) -
+each file's columns are reordered with a single gather per block of rows 
+through an index built from its header, with probes the file lacks filled 
+by the missing val. Files are gathered in parallel and written out in input
+order; if every input is a binary store and a store is requested, matrix columns 
+are copied directly without going through text
 """
 
+import os
 import sys
-import gzip
+import shutil
+import tempfile
 import argparse
+import multiprocessing
+import numpy as np
 import matrix_utils
+import matrix_store
+
+# store rows copied at once when combining stores
+STORE_CHUNK = 256
+
+# chars of 'wide' file text gathered at once (at least one row)
+GATHER_CHARS = 4 * 1024 * 1024
+
+# runs of gathered fields shorter than this (bytes, on average) are copied 
+# through a byte index rather than sliced out one by one
+SLICE_BYTES = 64
 
 def parse_args():
     parser = argparse.ArgumentParser(description='safely combine multiple files',
@@ -22,7 +44,7 @@ def parse_args():
 
     parser.add_argument('-p', '--probes', type=str,
                         help='subset of probes to ensure are in output file ' + 
-                        '[default=inferred from 1st line of 1st file]')
+                        '[default=union of probes in all inputs]')
     
     parser.add_argument('-x', '--probe_start_idx', type=int, default=4,
                         help='start index of methyl probes [default=4]')
@@ -30,59 +52,216 @@ def parse_args():
     parser.add_argument('-m', '--missing_val', type=float, default=-1,
                         help='placeholder value to use for missing probe vals [default=-1]')
     
+    parser.add_argument('-s', '--store', action='store_true',
+                        help='write output as binary matrix store directory ' +
+                        '(missing probe vals are stored as NaN)')
+
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of input files gathered at once [default=1]')
+
+    parser.add_argument('--temp_dir', type=str,
+                        help='directory for gathered parts when using workers ' +
+                        '[default=system temp]')
         
+    parser.add_argument('--bgzf', action='store_true',
+                        help='write gzipped output as seekable block gzip (BGZF)')
+
+    parser.add_argument('--compress_threads', type=int, default=1,
+                        help='threads compressing gzipped output in the ' +
+                        'background [default=1]')
+
     args = parser.parse_args()
+    if args.store and not args.output:
+        raise Exception('output directory (-o) required to write store')
     return args
 
 
+def read_header(file):
+    f = matrix_utils.open_file(file)
+    header = f.readline().rstrip('\n').split('\t')
+    f.close()
+    return header
+
+
+def check_meta_columns(files, headers, probe_start_idx):
+    """ raise unless every input has the same metadata columns """
+    meta_columns = headers[0][:probe_start_idx]
+    for file, header in zip(files[1:], headers[1:]):
+        if header[:probe_start_idx] != meta_columns:
+            raise Exception(f'metadata columns of {file} ' +
+                            f'{header[:probe_start_idx]} do not match ' +
+                            f'{files[0]} {meta_columns}')
+    return meta_columns
+
+
+def gather_runs(cols):
+    """ 
+    split gather cols into runs of consecutive fields - returns first and 
+    last field of each run
+    """
+    breaks = np.flatnonzero(np.diff(cols) != 1) + 1
+    return cols[np.r_[0, breaks]], cols[np.r_[breaks - 1, len(cols) - 1]]
+
+
+def gather_block(lines, first, last, missing):
+    """
+    gather fields of a block of lines - lines are laid out as one byte array
+    with a sentinel field holding the missing val string after each line's
+    last field, field offsets for every run of consecutive gathered fields 
+    are picked with one fancy index, and each run's bytes are copied 
+    through unchanged. Returns gathered text
+    """
+    text = ''.join(line + '\t' + missing + '\t' for line in lines).encode()
+    buf = np.frombuffer(text, dtype=np.uint8)
+    # every field (sentinel included) ends in a tab - field i of the block
+    # starts just after tab i - 1
+    tabs = np.concatenate([[-1], np.flatnonzero(buf == ord('\t'))])
+    rows = np.arange(len(lines))[:, None] * ((len(tabs) - 1) // len(lines))
+    run_starts = tabs[rows + first] + 1
+    # each run keeps the tab that follows it
+    run_ends = tabs[rows + last + 1] + 1
+    if len(buf) < SLICE_BYTES * run_starts.size:
+        # short runs - gather every byte with one index, then swap the tab
+        # ending each row for a newline
+        lengths = (run_ends - run_starts).ravel()
+        offsets = np.cumsum(lengths) - lengths
+        out = buf[np.repeat(run_starts.ravel() - offsets, lengths) + 
+                  np.arange(lengths.sum())]
+        row_lengths = lengths.reshape(len(lines), -1).sum(axis=1)
+        out[np.cumsum(row_lengths) - 1] = ord('\n')
+        return out.tobytes().decode()
+
+    # long runs - slice them straight out of the text
+    run_ends[:, -1] -= 1
+    parts = []
+    for row_starts, row_ends in zip(run_starts.tolist(), run_ends.tolist()):
+        parts.extend(text[start:end] for start, end in zip(row_starts, row_ends))
+        parts.append(b'\n')
+    return b''.join(parts).decode()
+
+
+def gather_file(file, probes, probe_start_idx, missing, out_file, 
+                block_chars=GATHER_CHARS):
+    """
+    write rows of file to out_file with probe columns in probes order - 
+    blocks of rows are gathered at once through an index built from the
+    header, probes missing from file point at a sentinel field holding 
+    missing val string
+    """
+    print(f"reading {file}", file=sys.stderr)
+    f = matrix_utils.open_file(file, threads=matrix_utils.DECOMPRESS_THREADS)
+    header = f.readline().rstrip('\n').split('\t')
+    index = matrix_utils.gather_index(header[probe_start_idx:], probes)
+    # shift into line fields, sentinel goes after last field
+    sentinel = len(header)
+    cols = np.concatenate([np.arange(probe_start_idx), index + probe_start_idx])
+    first, last = gather_runs(cols)
+
+    counter = 0
+    lines = []
+    chars = 0
+    for line in f:
+        if line.strip() == '':
+            continue
+        line = line.rstrip('\n')
+        num_fields = line.count('\t') + 1
+        if num_fields != sentinel:
+            raise Exception(f'expected {sentinel} fields, got {num_fields} ' +
+                            f'in {file}: {line.split(chr(9), 1)[0]}')
+        lines.append(line)
+        chars += len(line)
+        if chars >= block_chars:
+            out_file.write(gather_block(lines, first, last, missing))
+            counter += len(lines)
+            lines = []
+            chars = 0
+    if lines:
+        out_file.write(gather_block(lines, first, last, missing))
+        counter += len(lines)
+    f.close()
+    return counter
+
+
+def gather_part(job):
+    """ gather one input file into its own part file (worker process) """
+    file, part, probes, probe_start_idx, missing = job
+    with open(part, 'w') as out_file:
+        gather_file(file, probes, probe_start_idx, missing, out_file)
+    return part
+
+
+def combine_stores(files, probes, output):
+    """ copy store matrices straight into new store with probes order """
+    stores = [matrix_store.MatrixStore(file) for file in files]
+    check_meta_columns(files, [store.meta_columns for store in stores],
+                       len(stores[0].meta_columns))
+    writer = matrix_store.StoreWriter(output, stores[0].meta_columns, probes)
+    for file, store in zip(files, stores):
+        print(f"reading {file}", file=sys.stderr)
+        index = matrix_utils.gather_index(store.probes, probes)
+        for start in range(0, len(store), STORE_CHUNK):
+            block = matrix_utils.gather_vals(store.matrix[start:start + STORE_CHUNK],
+                                             index)
+            writer.write_rows(store.meta[start:start + STORE_CHUNK].tolist(), block)
+    writer.close()
+
+
 def main():
     args = parse_args()
     
+    headers = [read_header(file) for file in args.input]
+    header_cols = check_meta_columns(args.input, headers, args.probe_start_idx)
+
     probes = []
-    # read probes from file if supplied, else read from input file
+    # read probes from file if supplied, else union of probes in all inputs
     if args.probes:
         with open(args.probes, 'r') as f:
             for line in f:
                 probes.append(line.rstrip().split('\t')[0])
+        probes = sorted(set(probes))
     else:
-        f = matrix_utils.open_file(args.input[0])
-        header = f.readline().rstrip().split('\t')
-        probes = header[args.probe_start_idx:]
-        f.close()
-      
-    # sort to put probes in order roughly
-    probes = sorted(probes)       
+        probes = matrix_utils.probe_union(header[args.probe_start_idx:]
+                                          for header in headers)
     print(f'{len(probes)} probes loaded', file=sys.stderr)
- 
+
+    if args.store:
+        if not all(matrix_store.is_store(file) for file in args.input):
+            raise Exception('all inputs must be stores to write store')
+        combine_stores(args.input, probes, args.output)
+        return
+
     out_file = sys.stdout
     if args.output:
-        out_file = matrix_utils.open_output_file(args.output)   
+        out_file = matrix_utils.open_output_file(args.output, blocked=args.bgzf,
+                                                 threads=args.compress_threads)
 
-    header_cols = ['case','sample','biospecimen','tissue']
     header_cols.extend(probes)
     print('\t'.join(header_cols), file=out_file)
-    
-    for file in args.input: 
-        print(f"reading {file}", file=sys.stderr)
-        f = matrix_utils.open_file(file)
-        # read header and record col index for each probe name
-        header = f.readline().rstrip().split('\t')
-        header_map = {}
-        for i in range(0,len(header)):
-            header_map[header[i]] = i
-            
-        col_idxs = []
-        for p in probes:
-            col_idxs.append(header_map[p])
-                
-        for line in f:
-            fields = line.rstrip().split('\t')
-            vals = fields[0:4]
-            for idx in col_idxs:
-                vals.append(fields[idx])
-            print('\t'.join(vals), file=out_file)
-        f.close()
+    missing = '{0:0.7f}'.format(args.missing_val)
+
+    if args.workers > 1:
+        # gather files in parallel into part files, then copy parts in order
+        work_dir = tempfile.mkdtemp(prefix='heisenberg_combine_', dir=args.temp_dir)
+        jobs = [(file, os.path.join(work_dir, f'part_{i}.tsv'), probes,
+                 args.probe_start_idx, missing)
+                for i, file in enumerate(args.input)]
+        pool = None
+        try:
+            pool = multiprocessing.get_context('fork').Pool(args.workers)
+            for part in pool.imap(gather_part, jobs):
+                with open(part, 'r') as f:
+                    shutil.copyfileobj(f, out_file)
+                os.remove(part)
+        finally:
+            # stop workers before removing the parts they may still write
+            if pool != None:
+                pool.terminate()
+                pool.join()
+            shutil.rmtree(work_dir, ignore_errors=True)
+    else:
+        for file in args.input: 
+            gather_file(file, probes, args.probe_start_idx, missing, out_file)
     out_file.close()
             
 if __name__ == "__main__":
-    main()    
\ No newline at end of file
+    main()
@@ -0,0 +1,57 @@
+#! /usr/bin/env python3
+
+"""
+Convert 'wide' methylation file into binary matrix store so downstream
+modules can memory map probe values instead of re-parsing text
+"""
+
+import sys
+import argparse
+import matrix_utils
+import matrix_store
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='convert wide file into ' +
+                                     'binary matrix store',
+                                     prog='heisenberg convert')
+    parser.add_argument('-i', '--input', type=str,
+                        help='source file of methylation values', required=True)
+
+    parser.add_argument('-o', '--output', type=str,
+                        help='store directory to write', required=True)
+
+    parser.add_argument('-p', '--probe_start_idx', type=int, default=4,
+                        help='column index of first methyl probe in input [default=4]')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+
+    print(f'reading from input file: {args.input}', file=sys.stderr)
+    f = matrix_utils.open_file(args.input, threads=matrix_utils.DECOMPRESS_THREADS)
+    header = f.readline().rstrip('\n').split('\t')
+
+    writer = matrix_store.StoreWriter(args.output,
+                                      header[:args.probe_start_idx],
+                                      header[args.probe_start_idx:])
+    counter = 0
+    for line in f:
+        if line.strip() == '':
+            continue
+        counter += 1
+        if counter % 100 == 0:
+            print(f'{counter} lines converted', file=sys.stderr)
+        fields = line.rstrip('\n').split('\t')
+        vals = matrix_utils.parse_probe_vals(fields[args.probe_start_idx:])
+        writer.write_row(fields[:args.probe_start_idx], vals)
+    f.close()
+    writer.close()
+
+    print(f'{counter} samples written to {args.output}...completed',
+          file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@ Handles any file with sample identifier in first column
 import sys
 import gzip
 import matrix_utils
+import matrix_index
 
 if len(sys.argv) < 3:
     print('\nusage: extract_methyl_samples.py samples.txt methyl.tsv.gz\n')
@@ -23,8 +24,16 @@ with open(sample_file, 'r') as f:
         samples.add(line.rstrip())
 
 f = matrix_utils.open_file(methyl_file)
-for line in f:
-    fields = line.rstrip().split('\t')
-    if line.startswith('case') or fields[0] in samples:
+
+# seek straight to requested rows if file has been indexed
+index = matrix_index.load_index(methyl_file)
+if index != None:
+    print(f.readline(), end='')
+    for line in index.read_rows(index.rows_for(samples)):
         print(line, end='')
+else:
+    for line in f:
+        fields = line.rstrip().split('\t')
+        if line.startswith('case') or fields[0] in samples:
+            print(line, end='')
 f.close()            
\ No newline at end of file
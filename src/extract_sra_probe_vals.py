@@ -33,7 +33,7 @@ def main():
     if args.output:
         output = matrix_utils.open_output_file(args.output)
     
-    f = matrix_utils.open_file(args.input)
+    f = matrix_utils.open_file(args.input, threads=matrix_utils.DECOMPRESS_THREADS)
     for line in f:
         # skip all lines until matrix table starts, then print remainder
         if line.startswith('!series_matrix_table_begin'):
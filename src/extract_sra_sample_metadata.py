@@ -33,42 +33,42 @@ def parse_args():
     return args
 
 
-def main():
-    args = parse_args()
-
+def parse_transforms(transform_args):
+    """ parse Y=X transform args into dict of Y referencing X """
     transforms = {}
-    if args.transform:
-        for val in args.transform:
+    if transform_args:
+        for val in transform_args:
             pieces = val.split('=')
             transforms[pieces[0]] = pieces[1]
-    samples = None
-    vals_map = {}
-    
-    out_file = sys.stdout
-    if args.output:
-        out_file = open(args.output, 'w')
-    
-    f = matrix_utils.open_file(args.file)
-    for line in f:
-        if line.startswith('!Sample_geo_accession'):
+    return transforms
+
+
+def collect_meta(line, metas, vals_map):
+    """
+    record vals of any requested metadata field found on series_matrix 
+    line in vals_map - returns sample ids if line is the accession line
+    """
+    if line.startswith('!Sample_geo_accession'):
+        fields = line.rstrip().replace('"','').split('\t')
+        return fields[1:]
+    for meta in metas:
+        meta_key = '"' + meta + ':'
+        if line.startswith('!' + meta):
             fields = line.rstrip().replace('"','').split('\t')
-            samples = fields[1:]
-        else:
-            for meta in args.meta:
-                meta_key = '"' + meta + ':'
-                if line.startswith('!' + meta):
-                    fields = line.rstrip().replace('"','').split('\t')
-                    vals_map[meta] = fields[1:]
-                elif line.startswith('!Sample_characteristics_ch') and meta_key in line:
-                    fields = line.rstrip().replace('"', '').split('\t')
-                    vals_map[meta] = [i.replace(meta + ': ', '') for i in fields[1:]]
-    f.close()
+            vals_map[meta] = fields[1:]
+        elif line.startswith('!Sample_characteristics_ch') and meta_key in line:
+            fields = line.rstrip().replace('"', '').split('\t')
+            vals_map[meta] = [i.replace(meta + ': ', '') for i in fields[1:]]
+    return None
+
 
+def write_meta(samples, vals_map, transforms, prefix, out_file):
+    """ print one row per sample of sample id and its metadata vals """
     for i in range(0, len(samples)):
         sample = samples[i]
         vals = [sample]
-        if args.prefix:
-            vals.insert(0, args.prefix)
+        if prefix:
+            vals.insert(0, prefix)
         for meta, meta_vals in vals_map.items():
             # apply data transformation if needed
             display_val = meta_vals[i]
@@ -77,6 +77,27 @@ def main():
             
             vals.append(display_val)
         print('\t'.join(vals), file=out_file)
+
+
+def main():
+    args = parse_args()
+
+    transforms = parse_transforms(args.transform)
+    samples = None
+    vals_map = {}
+    
+    out_file = sys.stdout
+    if args.output:
+        out_file = open(args.output, 'w')
+    
+    f = matrix_utils.open_file(args.file, threads=matrix_utils.DECOMPRESS_THREADS)
+    for line in f:
+        line_samples = collect_meta(line, args.meta, vals_map)
+        if line_samples != None:
+            samples = line_samples
+    f.close()
+
+    write_meta(samples, vals_map, transforms, args.prefix, out_file)
     out_file.close()
         
 
@@ -0,0 +1,117 @@
+"""
+Vectorized fixed-point formatting of probe val rows.
+
+Whole rows (or blocks of rows) are rendered at once - every val is scaled to
+an integer number of decimal units, split into integer and fraction digits
+and written into one preallocated array of chars, instead of calling
+'{0:0.7f}'.format once per val. Output matches str.format exactly - the
+scaling multiply is exact for float32 vals, and the few float64 vals it
+leaves on or next to a rounding tie are rounded by str.format instead.
+"""
+
+import numpy as np
+
+# default number of decimals written for probe vals
+PRECISION = 7
+
+# largest magnitude that survives scaling as an exactly represented integer
+MAX_EXACT = 2 ** 53
+
+TAB = ord('\t')
+NEWLINE = ord('\n')
+
+# zero padded chars of every 4 digit number packed into one 32 bit word, so 
+# digits are looked up four at a time rather than peeled off one by one
+DIGIT_WORDS = np.array([list('{0:04d}'.format(i).encode()) for i in range(10000)],
+                       dtype=np.uint8).view(np.uint32).ravel()
+
+
+def digit_chars(vals, width):
+    """ (vals x width) array of zero padded decimal digit chars of int vals """
+    chunks = -(-width // 4)
+    words = np.empty((len(vals), chunks), dtype=np.uint32)
+    for chunk in range(chunks - 1, -1, -1):
+        vals, low = np.divmod(vals, 10000)
+        words[:, chunk] = DIGIT_WORDS[low]
+    return words.view(np.uint8)[:, chunks * 4 - width:]
+
+
+def format_rows(vals, precision=PRECISION, na=None):
+    """
+    format (rows x vals) block as list of tab delimited strings, one per row
+    with every val fixed-point to precision decimals. NaN is written as na
+    if given (same as str.format otherwise)
+    """
+    block = np.atleast_2d(np.asarray(vals, dtype=np.float64))
+    num_rows, num_cols = block.shape
+    if num_cols == 0:
+        return [''] * num_rows
+    flat = block.ravel()
+    scale = 10 ** precision
+
+    # anything that won't scale exactly (NaN, inf, huge) gets a text token
+    unrounded = np.abs(flat) * scale
+    scaled = np.rint(unrounded)
+    special = ~(scaled < MAX_EXACT)
+    scaled[special] = 0
+
+    # multiply can round a float64 val onto (or off) a half way point, so
+    # vals within rounding error of one are settled by correctly rounded
+    # str.format
+    with np.errstate(invalid='ignore'):
+        tie = np.abs(unrounded - np.floor(unrounded) - 0.5) <= 2 * np.spacing(unrounded)
+    for i in np.flatnonzero(tie & ~special):
+        text = '{0:.{1}f}'.format(abs(flat[i]), precision)
+        scaled[i] = int(text.replace('.', ''))
+    scaled = scaled.astype(np.int64)
+    ints = scaled // scale
+    fracs = scaled % scale
+
+    # signbit keeps str.format's '-0.0000000' for vals that round to zero
+    negative = np.signbit(flat) & ~special
+    max_digits = len(str(int(ints.max())))
+    num_digits = np.ones(len(flat), dtype=np.int64)
+    for place in range(1, max_digits):
+        num_digits += ints >= 10 ** place
+
+    tokens = {}
+    for i in np.flatnonzero(special):
+        val = flat[i]
+        token = na if na != None and np.isnan(val) else '{0:.{1}f}'.format(val, precision)
+        tokens.setdefault(token, []).append(i)
+
+    # lay every field out right aligned in a fixed width row of chars 
+    # (sign, integer digits, point, fraction digits, separator) then keep
+    # only the chars that are actually used
+    point = 1 + max_digits
+    width = max([point + precision + 2] + [len(t) + 1 for t in tokens])
+    chars = np.zeros((len(flat), width), dtype=np.uint8)
+    used = np.zeros((len(flat), width), dtype=bool)
+
+    chars[:, 0] = ord('-')
+    used[:, 0] = negative
+    chars[:, 1:point] = digit_chars(ints, max_digits)
+    used[:, 1:point] = np.arange(max_digits) >= (max_digits - num_digits)[:, None]
+    if precision > 0:
+        chars[:, point] = ord('.')
+        used[:, point] = True
+        chars[:, point + 1:point + 1 + precision] = digit_chars(fracs, precision)
+        used[:, point + 1:point + 1 + precision] = True
+
+    for token, idxs in tokens.items():
+        used[idxs] = False
+        for offset, char in enumerate(token.encode()):
+            chars[idxs, offset] = char
+        used[idxs, :len(token)] = True
+
+    # every field is followed by a tab, or newline at the end of a row
+    chars[:, -1] = TAB
+    chars[num_cols - 1::num_cols, -1] = NEWLINE
+    used[:, -1] = True
+
+    return chars[used].tobytes().decode().split('\n')[:num_rows]
+
+
+def format_row(vals, precision=PRECISION, na=None):
+    """ format single row of vals as tab delimited string """
+    return format_rows(vals, precision=precision, na=na)[0]
@@ -11,6 +11,9 @@ import invert_sra_table as invert_table
 import subset_probes_samples as subset
 import combine_sra_projects as combine
 import print_cell as cell
+import convert_matrix as convert
+import index_matrix as index
+import ingest_series_matrix as ingest
 
 def usage():
     print(
@@ -30,12 +33,18 @@ heisenberg.py <module>
   extract_sra_probe      extract SRA probe values from series_matrix.txt files
   invert                 turn 'long' file (probes as rows) into 'wide' (probes
                          as columns)
+  ingest                 turn series_matrix.txt file into 'wide' file (or
+                         binary store) and sample metadata in one pass
 
   ---- utility -----------------------------------------------------------------
   extract_sra_meta       extract SRA sample metadata from series_matrix.txt
   subset                 extract probe or sample subset from master file
   combine                safely combine multiple files into one
   cell                   print value of master file cell[x,y]                       
+  convert                convert wide file into binary matrix store for fast
+                         loading (can be used as input to any module)
+  index                  build row offset index so cell/subset can seek
+                         straight to requested samples
     '''
     )
 
@@ -46,10 +55,13 @@ modules = {
     'mix' : sim_mix,
     'extract_sra_probe' : extract_probe,
     'invert' : invert_table,
+    'ingest' : ingest,
     'extract_sra_meta' : extract_meta,
     'subset' : subset,
     'combine' : combine,
-    'cell' : cell }
+    'cell' : cell,
+    'convert' : convert,
+    'index' : index }
 
 if len(sys.argv) < 2 or sys.argv[1] not in modules:
     usage()
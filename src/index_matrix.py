@@ -0,0 +1,33 @@
+#! /usr/bin/env python3
+
+"""
+Build sidecar row/column index for 'wide' methylation file so row lookups
+(cell, subset -s, sample extraction) can seek instead of scanning
+"""
+
+import sys
+import argparse
+import matrix_index
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='build row offset index ' +
+                                     'for wide file',
+                                     prog='heisenberg index')
+    parser.add_argument('-i', '--input', type=str,
+                        help='source file of methylation values - plain text ' +
+                        'or BGZF (plain gzip can\'t be seeked)', required=True)
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+
+    print(f'indexing rows of {args.input}', file=sys.stderr)
+    index = matrix_index.build_index(args.input)
+    print(f'{len(index)} rows, {len(index.header)} columns indexed to ' +
+          f'{matrix_index.index_path(args.input)}', file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
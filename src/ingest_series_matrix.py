@@ -0,0 +1,345 @@
+#! /usr/bin/env python3
+
+"""
+Read SRA series_matrix.txt.gz file once and write 'wide' methylation file
+(or binary matrix store) directly, capturing requested sample metadata in
+the same pass - replaces extract_sra_probe -> invert -> extract_sra_meta,
+each of which reads the whole file again
+
+Several series (glob, repeated -i or manifest) are ingested concurrently on
+a bounded pool of worker processes, each into a temp store, then merged into
+one output over the union of their probes in the order first seen, so a
+series keeps its own column order whether ingested alone or in a group -
+probes a series lacks are missing (NA) for its samples
+"""
+
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+import matrix_utils
+import format_utils
+import matrix_store
+import transpose_utils
+import invert_sra_table as invert
+import extract_sra_sample_metadata as extract_meta
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='convert SRA series matrix ' +
+                                     'into wide file in a single pass',
+                                     prog='heisenberg ingest')
+    parser.add_argument('-i', '--input', type=str, action='append',
+                        help='series_matrix.txt file of methylation values - ' +
+                        'repeat or use a quoted glob to ingest several series')
+
+    parser.add_argument('-f', '--manifest', type=str,
+                        help='file listing series_matrix.txt files to ingest, ' +
+                        'one per line')
+
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of series ingested at once [default=1]')
+
+    parser.add_argument('-o', '--output', type=str,
+                        help='output file to write [default=STDOUT]')
+
+    parser.add_argument('-s', '--store', action='store_true',
+                        help='write output as binary matrix store directory')
+
+    parser.add_argument('-t', '--tissue', type=str,
+                        help='value to write in tissue column [default=normal ' +
+                        'peripheral blood]', default='normal peripheral blood')
+
+    parser.add_argument('-m', '--meta', type=str, action='append',
+                        help='sample metadata field to capture (repeatable)')
+
+    parser.add_argument('-u', '--meta_output', type=str,
+                        help='file to write captured sample metadata to')
+
+    parser.add_argument('-p', '--prefix', type=str,
+                        help='start each metadata row with this')
+
+    parser.add_argument('-r', '--transform', type=str, action='append',
+                        help='transform metadata val Y to X in output [Y=X]')
+
+    parser.add_argument('--memory_mb', type=int,
+                        default=transpose_utils.MEMORY_MB,
+                        help='memory budget for buffered probe vals in MB ' +
+                        f'[default={transpose_utils.MEMORY_MB}]')
+
+    parser.add_argument('--temp_dir', type=str,
+                        help='directory for spilled probe blocks [default=system temp]')
+
+    parser.add_argument('--bgzf', action='store_true',
+                        help='write gzipped output as seekable block gzip (BGZF)')
+
+    parser.add_argument('--compress_threads', type=int, default=1,
+                        help='threads compressing gzipped output in the ' +
+                        'background [default=1]')
+
+    args = parser.parse_args()
+    if not args.input and not args.manifest:
+        raise Exception('input series (-i) or manifest (-f) required')
+    if args.meta and not args.meta_output:
+        raise Exception('metadata output file (-u) required to capture metadata')
+    if args.store and not args.output:
+        raise Exception('output directory (-o) required to write store')
+    return args
+
+
+def read_series_matrix(file, metas, memory_mb, temp_dir):
+    """
+    single pass over series matrix - sample metadata lines are collected,
+    probe table rows are fed to transposer. Returns sample ids, metadata
+    vals, table biospecimens, probes and the transposer
+    """
+    samples = None
+    vals_map = {}
+    biospecimens = None
+    probes = []
+    transposer = None
+    table_started = False
+
+    f = matrix_utils.open_file(file, threads=matrix_utils.DECOMPRESS_THREADS)
+    try:
+        for line in f:
+            if line.startswith('!series_matrix_table_begin'):
+                table_started = True
+            elif line.startswith('!series_matrix_table_end'):
+                table_started = False
+            elif table_started:
+                # remove all double quotes around vals
+                fields = line.rstrip().replace('"', '').split('\t')
+                if transposer == None:
+                    biospecimens = fields[1:]
+                    transposer = transpose_utils.ProbeTransposer(len(biospecimens),
+                                                                 memory_mb=memory_mb,
+                                                                 temp_dir=temp_dir)
+                    continue
+                probes.append(fields[0])
+                invert.add_probe_line(transposer, fields)
+                if len(probes) % 100000 == 0:
+                    print(f'{len(probes)} probes read', file=sys.stderr)
+            elif line.startswith('!'):
+                line_samples = extract_meta.collect_meta(line, metas, vals_map)
+                if line_samples != None:
+                    samples = line_samples
+    except BaseException:
+        # caller only owns transposer (and its spilled blocks) on success
+        if transposer != None:
+            transposer.close()
+        raise
+    finally:
+        f.close()
+
+    if transposer == None:
+        raise Exception('no series matrix table found in: ' + file)
+    return samples, vals_map, biospecimens, probes, transposer
+
+
+def write_series_meta(samples, vals_map, args, out_file):
+    """
+    write captured metadata with one column per requested field in -m order,
+    so rows line up across series - fields a series lacks are written as NA
+    """
+    aligned = {}
+    for meta in args.meta:
+        if meta not in vals_map:
+            print(f'metadata field {meta} not found, writing NA', 
+                  file=sys.stderr)
+        aligned[meta] = vals_map.get(meta, ['NA'] * len(samples))
+    extract_meta.write_meta(samples, aligned,
+                            extract_meta.parse_transforms(args.transform),
+                            args.prefix, out_file)
+
+
+def write_store(transposer, biospecimens, probes, tissue, path):
+    """ write transposed sample rows straight into binary matrix store """
+    writer = matrix_store.StoreWriter(path,
+                                      ['case', 'sample', 'biospecimen', 'tissue'],
+                                      probes)
+    for start, chunk in transposer.sample_chunks():
+        # same identifiers x3 to match other files
+        meta = [[b, b, b, tissue]
+                for b in biospecimens[start:start + len(chunk)]]
+        writer.write_rows(meta, chunk)
+    writer.close()
+
+
+def series_files(inputs, manifest):
+    """ expand input globs and manifest into list of series files """
+    files = []
+    for pattern in inputs or []:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise Exception('no series files match: ' + pattern)
+        files.extend(matches)
+    if manifest:
+        with open(manifest, 'r') as f:
+            for line in f:
+                if line.strip() != '' and not line.startswith('#'):
+                    files.append(line.strip())
+    return files
+
+
+def ingest_series(job):
+    """
+    ingest one series into a store (and metadata file) - run in worker
+    processes when several series are ingested at once
+    """
+    file, store_path, meta_path, args = job
+    print(f'reading series matrix from {file}', file=sys.stderr)
+    samples, vals_map, biospecimens, probes, transposer = read_series_matrix(
+        file, args.meta or [], args.memory_mb // args.workers or 1, 
+        args.temp_dir)
+    try:
+        write_store(transposer, biospecimens, probes, args.tissue, store_path)
+    finally:
+        transposer.close()
+
+    if args.meta:
+        if samples == None:
+            raise Exception('no sample accession line found in: ' + file)
+        with open(meta_path, 'w') as out_file:
+            write_series_meta(samples, vals_map, args, out_file)
+    print(f'{file}: {len(probes)} probes x {len(biospecimens)} samples', 
+          file=sys.stderr)
+    return file
+
+
+def check_duplicate_samples(files, stores):
+    """ raise if any sample id appears in more than one series """
+    seen = {}
+    for file, store in zip(files, stores):
+        for sample in store.meta[:, 1].tolist():
+            if sample in seen:
+                raise Exception(f'sample {sample} is in both {seen[sample]} ' +
+                                f'and {file}')
+            seen[sample] = file
+
+
+def merge_stores(files, store_paths, args):
+    """
+    merge per series stores into single output with union of their probes,
+    reordering each store's columns in bulk by gather index
+    """
+    stores = [matrix_store.MatrixStore(path) for path in store_paths]
+    check_duplicate_samples(files, stores)
+    probes = matrix_utils.probe_union([store.probes for store in stores],
+                                      keep_order=True)
+    print(f'merging {len(stores)} series over {len(probes)} probes', 
+          file=sys.stderr)
+
+    if args.store:
+        writer = matrix_store.StoreWriter(args.output, stores[0].meta_columns,
+                                          probes)
+    else:
+        output = sys.stdout
+        if args.output:
+            output = matrix_utils.open_output_file(args.output,
+                                                   blocked=args.bgzf,
+                                                   threads=args.compress_threads)
+        print('\t'.join(stores[0].meta_columns + probes), file=output)
+
+    # bound rows gathered at once by memory budget
+    chunk_size = max(1, args.memory_mb * 1024 * 1024 // (8 * max(1, len(probes))))
+    for store in stores:
+        index = matrix_utils.gather_index(store.probes, probes)
+        for start in range(0, len(store), chunk_size):
+            block = matrix_utils.gather_vals(store.matrix[start:start + chunk_size],
+                                             index)
+            meta = store.meta[start:start + chunk_size].tolist()
+            if args.store:
+                writer.write_rows(meta, block)
+            else:
+                for fields, row in zip(meta, format_utils.format_rows(block, na='NA')):
+                    print('\t'.join(fields + [row]), file=output)
+
+    if args.store:
+        writer.close()
+    else:
+        output.close()
+
+
+def ingest_many(files, args):
+    """
+    ingest series concurrently (at most workers at a time) into temp stores,
+    then merge them and their metadata in input order
+    """
+    work_dir = tempfile.mkdtemp(prefix='heisenberg_ingest_', dir=args.temp_dir)
+    pool = None
+    try:
+        jobs = [(file,
+                 os.path.join(work_dir, f'series_{i}.hstore'),
+                 os.path.join(work_dir, f'series_{i}.meta'),
+                 args)
+                for i, file in enumerate(files)]
+        if args.workers > 1:
+            # pool size caps how many series are ingested at once
+            pool = multiprocessing.get_context('fork').Pool(args.workers, 
+                                                            maxtasksperchild=1)
+            for file in pool.imap(ingest_series, jobs):
+                print(f'finished {file}', file=sys.stderr)
+        else:
+            for job in jobs:
+                ingest_series(job)
+
+        merge_stores(files, [store_path for _, store_path, _, _ in jobs], args)
+
+        if args.meta:
+            with open(args.meta_output, 'w') as out_file:
+                for _, _, meta_path, _ in jobs:
+                    with open(meta_path, 'r') as f:
+                        shutil.copyfileobj(f, out_file)
+    finally:
+        # stop workers before removing the stores they may still write
+        if pool != None:
+            pool.terminate()
+            pool.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    args = parse_args()
+
+    files = series_files(args.input, args.manifest)
+    if len(files) > 1:
+        print(f'ingesting {len(files)} series with {args.workers} workers',
+              file=sys.stderr)
+        ingest_many(files, args)
+        print('completed', file=sys.stderr)
+        return
+
+    print(f'reading series matrix from {files[0]}', file=sys.stderr)
+    samples, vals_map, biospecimens, probes, transposer = read_series_matrix(
+        files[0], args.meta or [], args.memory_mb, args.temp_dir)
+    print(f'{len(probes)} probes x {len(biospecimens)} samples read',
+          file=sys.stderr)
+
+    try:
+        if args.store:
+            write_store(transposer, biospecimens, probes, args.tissue,
+                        args.output)
+        else:
+            output = sys.stdout
+            if args.output:
+                output = matrix_utils.open_output_file(args.output,
+                                                       blocked=args.bgzf,
+                                                       threads=args.compress_threads)
+            invert.write_wide(transposer, biospecimens, probes, args.tissue,
+                              output)
+            output.close()
+    finally:
+        transposer.close()
+
+    if args.meta:
+        if samples == None:
+            raise Exception('no sample accession line found in: ' + files[0])
+        with open(args.meta_output, 'w') as out_file:
+            write_series_meta(samples, vals_map, args, out_file)
+    print('completed', file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -7,81 +7,101 @@ columns and turn into file with samples and rows and probes as columns
 print extra columns for sample/biospecimen and tissue type to match
 format for TCGA wide methylation files -- tissue type for all samples
 is peripheral blood
+
+probe rows are streamed into blocks that are spilled to temp files, then
+read back a chunk of samples at a time, so memory use is bounded by
+--memory_mb rather than size of input
 """
 
 import sys
-import gzip
+import argparse
+import numpy as np
 import matrix_utils
+import format_utils
+import transpose_utils
 
 def parse_args():
     parser = argparse.ArgumentParser(description='invert table with probes ' +
                                      'as rows to probes as columns',
                                      prog="heisenberg invert")
-    parser.add_argument('-i', '--input', type=str, 
-                        help='input file with probe values as rows', 
+    parser.add_argument('-i', '--input', type=str,
+                        help='input file with probe values as rows',
                         required=True)
 
-    parser.add_argument('-o', '--output', type=str, 
+    parser.add_argument('-o', '--output', type=str,
                         help='output file to write [default=STDOUT]')
 
-    parser.add_argument('-t', '--tissue', type=str, 
+    parser.add_argument('-t', '--tissue', type=str,
                         help='value to write in tissue column [default=normal ' +
                         'peripheral blood]', default='normal peripheral blood')
 
-        
+    parser.add_argument('-m', '--memory_mb', type=int,
+                        default=transpose_utils.MEMORY_MB,
+                        help='memory budget for buffered probe vals in MB ' +
+                        f'[default={transpose_utils.MEMORY_MB}]')
+
+    parser.add_argument('--temp_dir', type=str,
+                        help='directory for spilled probe blocks [default=system temp]')
+
     args = parser.parse_args()
     return args
 
 
-def main():
-    args = parse_args()
+def add_probe_line(transposer, fields):
+    """
+    parse probe vals of long file row (probe id first) and add to transposer
+    - short rows and empty or unparseable vals are missing (NaN)
+    """
+    vals = np.full(transposer.num_samples, np.nan, dtype=np.float32)
+    probe_vals = fields[1:transposer.num_samples + 1]
+    vals[:len(probe_vals)] = matrix_utils.parse_probe_vals(probe_vals)
+    transposer.add_probe(vals)
 
-    biospecimen_probes = {}
-    biospecimen_indexes = None
-    probes = []
-    f = matrix_utils.open_file(args.input)
-    
-    for line in f:
-        fields = line.rstrip('\n').split('\t')
-        if fields[0].startswith('ID_REF'):
-            biospecimen_indexes = fields
-            for i in range(1,len(fields)):
-                biospecimen_probes[fields[i]] = {}
-        else:        
-            probe_id = fields[0]
-            probes.append(probe_id)
-            for i in range(1, len(biospecimen_indexes)):
-                if i >= len(fields):
-                    probe_val = 'NA'
-                else:
-                    probe_val = fields[i]
-                    if probe_val == '':
-                            probe_val = 'NA'
-                biospecimen = biospecimen_indexes[i]
-                biospecimen_probes[biospecimen][probe_id] = probe_val
-    f.close()
-
-    output = sys.stdout
-    if args.output:
-        output = matrix_utils.open_output_file(args.output)
 
+def write_wide(transposer, biospecimens, probes, tissue, output):
+    """ write transposed sample rows as wide file, missing vals as NA """
     headers = ['case', 'sample', 'biospecimen', 'tissue']
-    for probe in probes:
-        headers.append(probe)
+    headers.extend(probes)
     print("\t".join(headers), file=output)
-    for biospecimen, probe_vals in biospecimen_probes.items():
-        vals = []
+    for start, chunk in transposer.sample_chunks():
+        for i, row in enumerate(chunk):
+            biospecimen = biospecimens[start + i]
             # same identifiers x3 to match other files
-        vals.append(biospecimen)
-        vals.append(biospecimen)
-        vals.append(biospecimen)
-        vals.append(args.tissue)
-        for probe in probes:
-            probe_val = probe_vals[probe]
-            vals.append(probe_val)
-        print("\t".join(vals), file=output)
-    
+            vals = [biospecimen, biospecimen, biospecimen, tissue]
+            vals.append(format_utils.format_row(row, na='NA'))
+            print("\t".join(vals), file=output)
+
+
+def main():
+    args = parse_args()
+
+    probes = []
+    f = matrix_utils.open_file(args.input, threads=matrix_utils.DECOMPRESS_THREADS)
+    fields = f.readline().rstrip('\n').split('\t')
+    if not fields[0].startswith('ID_REF'):
+        f.close()
+        raise Exception('no ID_REF header line at start of: ' + args.input)
+    biospecimens = fields[1:]
+
+    # spilled blocks are removed however reading or writing ends
+    with transpose_utils.ProbeTransposer(len(biospecimens),
+                                         memory_mb=args.memory_mb,
+                                         temp_dir=args.temp_dir) as transposer:
+        print(f'{len(biospecimens)} samples, buffering ' +
+              f'{transposer.block_probes} probes per block', file=sys.stderr)
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            probes.append(fields[0])
+            add_probe_line(transposer, fields)
+        f.close()
+        print(f'{len(probes)} probes read', file=sys.stderr)
+
+        output = sys.stdout
+        if args.output:
+            output = matrix_utils.open_output_file(args.output)
+        write_wide(transposer, biospecimens, probes, args.tissue, output)
+
     output.close()
-    
+
 if __name__ == "__main__":
-    main()    
\ No newline at end of file
+    main()
@@ -0,0 +1,226 @@
+"""
+Persistent sidecar row index for 'wide' methylation files.
+
+Index records the header (probe label -> column map) plus the offset of every
+sample row so individual rows can be read with a seek instead of a full scan.
+Offsets are whatever the binary reader reports from tell() - byte offsets for
+plain text files and BGZF virtual offsets for block gzip files (constant time
+seek). Plain gzip files aren't indexed - seeking one decompresses everything
+before the offset, so each lookup would cost as much as a scan.
+
+Index is written next to the file as <file>.hidx and is ignored if the file
+has changed since the index was built.
+"""
+
+import os
+import gzip
+import numpy as np
+import bgzf
+
+INDEX_SUFFIX = '.hidx'
+
+
+def index_path(file):
+    return file + INDEX_SUFFIX
+
+
+def open_binary(file):
+    """ open regular or gzipped file in binary mode for tell/seek access """
+    if bgzf.is_bgzf(file):
+        return bgzf.BgzfReader(file)
+    if file.endswith('.gz'):
+        return gzip.open(file, 'rb')
+    return open(file, 'rb')
+
+
+def is_seekable(file):
+    """ rows can be seeked to without decompressing all rows before them """
+    return bgzf.is_bgzf(file) or not file.endswith('.gz')
+
+
+def file_signature(file):
+    """ size and modification time used to detect stale indexes """
+    stat = os.stat(file)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+class RowIndex:
+    """ row offsets and column map for a single indexed file """
+
+    def __init__(self, file, header, offsets, cases, samples):
+        self.file = file
+        self.header = header
+        self.offsets = offsets
+        self.cases = cases
+        self.samples = samples
+        self.column_map = {label: i for i, label in enumerate(header)}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def column_for(self, label):
+        if label not in self.column_map:
+            raise Exception("col header not found: " + label)
+        return self.column_map[label]
+
+    def rows_for(self, keys, by='case'):
+        """
+        get row numbers (in file order) whose case or sample identifier
+        is in keys
+        """
+        ids = self.cases if by == 'case' else self.samples
+        return [i for i, val in enumerate(ids) if val in keys]
+
+    def read_rows(self, rows):
+        """ seek to and yield text line for each requested row number """
+        f = open_binary(self.file)
+        try:
+            for row in rows:
+                f.seek(int(self.offsets[row]))
+                yield f.readline().decode()
+        finally:
+            f.close()
+
+    def save(self):
+        with open(index_path(self.file), 'wb') as f:
+            np.savez(f,
+                     signature=file_signature(self.file),
+                     header=np.array(self.header, dtype=str),
+                     offsets=self.offsets,
+                     cases=np.array(self.cases, dtype=str),
+                     samples=np.array(self.samples, dtype=str))
+
+
+def build_index(file, sample_col='sample'):
+    """
+    scan file once recording offset, case and sample id of every row and
+    save index alongside file
+    """
+    if not is_seekable(file):
+        raise Exception('cannot index plain gzip file (seeks are not random ' +
+                        'access): ' + file + ' - rewrite it with --bgzf ' +
+                        'or decompress it first')
+    f = open_binary(file)
+    header = f.readline().decode().rstrip('\n').split('\t')
+
+    # default to sample index of 1 if header doesn't label it
+    sample_idx = header.index(sample_col) if sample_col in header else 1
+
+    offsets = []
+    cases = []
+    samples = []
+    while True:
+        offset = f.tell()
+        line = f.readline()
+        if not line:
+            break
+        if line.strip() == b'':
+            continue
+        fields = line.split(b'\t', sample_idx + 1)
+        offsets.append(offset)
+        cases.append(fields[0].decode())
+        samples.append(fields[sample_idx].decode().rstrip('\n'))
+    f.close()
+
+    index = RowIndex(file, header, np.array(offsets, dtype=np.int64),
+                     cases, samples)
+    index.save()
+    return index
+
+
+def load_index(file):
+    """ load sidecar index for file if one exists and is current """
+    path = index_path(file)
+    if not os.path.exists(path) or not is_seekable(file):
+        return None
+    with np.load(path) as data:
+        if not np.array_equal(data['signature'], file_signature(file)):
+            return None
+        return RowIndex(file,
+                        data['header'].tolist(),
+                        data['offsets'],
+                        data['cases'].tolist(),
+                        data['samples'].tolist())
+
+
+def data_start(file):
+    """ offset of first row after header line """
+    f = open_binary(file)
+    f.readline()
+    start = f.tell()
+    f.close()
+    return start
+
+
+def next_line_start(f, position):
+    """
+    offset of first line starting after position - callers pass the byte
+    just before the desired split so a line starting exactly there is kept
+    """
+    f.seek(position)
+    f.readline()
+    return f.tell()
+
+
+def row_shards(file, num_shards):
+    """
+    split data rows of file into roughly equal contiguous shards, returned as
+    list of (start, end) offsets for open_binary readers (end of None means
+    read to end of file). Uses row index if available, else splits by bytes 
+    for plain text or by blocks for BGZF. Plain gzip comes back as a single
+    shard - every shard would have to decompress all rows before its start
+    """
+    start = data_start(file)
+    if not is_seekable(file):
+        return [(start, None)]
+    index = load_index(file)
+    boundaries = []
+    if index != None:
+        offsets = index.offsets
+        for i in range(1, num_shards):
+            row = (len(offsets) * i) // num_shards
+            if row < len(offsets):
+                boundaries.append(int(offsets[row]))
+    elif bgzf.is_bgzf(file):
+        blocks = bgzf.block_offsets(file)
+        f = open_binary(file)
+        for i in range(1, num_shards):
+            b = (len(blocks) * i) // num_shards
+            if b == 0:
+                continue
+            # last byte of previous block
+            prev_compressed, prev_uncompressed = blocks[b - 1]
+            last = blocks[b][1] - prev_uncompressed - 1
+            boundaries.append(next_line_start(
+                f, bgzf.make_virtual_offset(prev_compressed, last)))
+        f.close()
+    else:
+        size = os.path.getsize(file)
+        f = open_binary(file)
+        for i in range(1, num_shards):
+            boundaries.append(next_line_start(f, (size * i) // num_shards - 1))
+        f.close()
+
+    shards = []
+    for boundary in boundaries + [None]:
+        if boundary != None and boundary <= start:
+            continue
+        shards.append((start, boundary))
+        start = boundary
+        if start == None:
+            break
+    return shards
+
+
+def read_shard(file, start, end):
+    """ yield text lines starting at offset start up to (not including) end """
+    f = open_binary(file)
+    try:
+        f.seek(start)
+        while end == None or f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode()
+    finally:
+        f.close()
@@ -0,0 +1,185 @@
+"""
+On-disk binary store for 'wide' methylation files.
+
+A store is a directory holding:
+
+    store.json      manifest (dimensions, probe start index, dtype)
+    matrix.f32      raw float32 probe values, one row per sample, row major
+                    (missing/unparseable vals stored as NaN)
+    probes.npy      probe labels in column order
+    meta.npy        sample metadata columns (case, sample, biospecimen,
+                    tissue and any demographic cols) as strings
+    meta_columns.npy  header labels for the metadata columns
+
+The probe matrix is memory mapped on open so readers never parse text.
+"""
+
+import os
+import json
+import numpy as np
+import format_utils
+
+MANIFEST = 'store.json'
+MATRIX = 'matrix.f32'
+PROBES = 'probes.npy'
+META = 'meta.npy'
+META_COLUMNS = 'meta_columns.npy'
+
+FORMAT_VERSION = 1
+
+
+def is_store(path):
+    """ check if path points at a binary matrix store """
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST))
+
+
+class StoreWriter:
+    """
+    write samples one row at a time into a new store - probe values are
+    appended straight to the raw matrix file, metadata is held until close
+    """
+
+    def __init__(self, path, meta_columns, probes):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.meta_columns = list(meta_columns)
+        self.probes = list(probes)
+        self.meta = []
+        self.has_missing = False
+        self.matrix_file = open(os.path.join(path, MATRIX), 'wb')
+
+    def write_row(self, meta, vals):
+        """ append sample metadata fields and array of probe vals """
+        vals = np.asarray(vals, dtype=np.float32)
+        if len(vals) != len(self.probes):
+            raise Exception(f'expected {len(self.probes)} probe vals, ' +
+                            f'got {len(vals)} for sample: {meta[1]}')
+        if not self.has_missing and np.isnan(vals).any():
+            self.has_missing = True
+        self.meta.append(list(meta))
+        self.matrix_file.write(vals.tobytes())
+
+    def write_rows(self, meta_rows, matrix):
+        """ append a block of samples at once """
+        for meta, vals in zip(meta_rows, matrix):
+            self.write_row(meta, vals)
+
+    def close(self):
+        self.matrix_file.close()
+        np.save(os.path.join(self.path, PROBES), np.array(self.probes, dtype=str))
+        np.save(os.path.join(self.path, META_COLUMNS),
+                np.array(self.meta_columns, dtype=str))
+        meta = np.array(self.meta, dtype=str).reshape(len(self.meta),
+                                                      len(self.meta_columns))
+        np.save(os.path.join(self.path, META), meta)
+
+        # write manifest last so a half written store is never detected
+        manifest = {'format_version': FORMAT_VERSION,
+                    'dtype': 'float32',
+                    'num_samples': len(self.meta),
+                    'num_probes': len(self.probes),
+                    'probe_start_idx': len(self.meta_columns),
+                    'has_missing': self.has_missing}
+        with open(os.path.join(self.path, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+
+class MatrixStore:
+    """ read only view of a store with probe matrix memory mapped """
+
+    def __init__(self, path):
+        if not is_store(path):
+            raise Exception("not a matrix store: " + path)
+        self.path = path
+        with open(os.path.join(path, MANIFEST), 'r') as f:
+            self.manifest = json.load(f)
+        self.probes = np.load(os.path.join(path, PROBES)).tolist()
+        self.meta_columns = np.load(os.path.join(path, META_COLUMNS)).tolist()
+        self.meta = np.load(os.path.join(path, META))
+        self.has_missing = self.manifest['has_missing']
+
+        shape = (self.manifest['num_samples'], self.manifest['num_probes'])
+        if shape[0] * shape[1] == 0:
+            self.matrix = np.zeros(shape, dtype=np.float32)
+        else:
+            self.matrix = np.memmap(os.path.join(path, MATRIX),
+                                    dtype=np.float32, mode='r', shape=shape)
+
+    @property
+    def probe_start_idx(self):
+        return len(self.meta_columns)
+
+    @property
+    def header(self):
+        """ column labels as they would appear in the 'wide' text file """
+        return self.meta_columns + self.probes
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def column_index(self, col):
+        """ convert 'wide' file column index into probe matrix column """
+        if col < self.probe_start_idx:
+            raise Exception(f'column {col} is sample metadata, not a probe')
+        return col - self.probe_start_idx
+
+    def text_vals(self, start, end):
+        """
+        rows [start, end) as float64 vals equal to those parsed back from the
+        'wide' text file - float32 vals are rounded to the written decimals
+        (scaling is exact for float32, and dividing the rounded integer back
+        down rounds correctly), so results match text input exactly
+        """
+        scale = 10 ** format_utils.PRECISION
+        block = np.array(self.matrix[start:end], dtype=np.float64)
+        return np.rint(block * scale) / scale
+
+    def format_row(self, i):
+        """ render sample row i as a tab delimited 'wide' file line """
+        return '\t'.join(self.meta[i].tolist() + 
+                         [format_utils.format_row(self.matrix[i], na='NA')])
+
+
+class StoreTextReader:
+    """
+    minimal read only file object over a store that yields 'wide' file lines
+    so text passthrough (subset, combine, extract) works on stores - callers
+    that parse vals should read MatrixStore.meta and matrix directly
+    """
+
+    def __init__(self, path):
+        self.store = MatrixStore(path)
+        self.next_row = -1
+
+    def readline(self):
+        if self.next_row < 0:
+            line = '\t'.join(self.store.header)
+        elif self.next_row < len(self.store):
+            line = self.store.format_row(self.next_row)
+        else:
+            return ''
+        self.next_row += 1
+        return line + '\n'
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if line == '':
+            raise StopIteration
+        return line
+
+    def seek(self, offset):
+        if offset != 0:
+            raise Exception('matrix store text reader can only seek to 0')
+        self.next_row = -1
+
+    def close(self):
+        self.store = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
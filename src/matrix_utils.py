@@ -3,7 +3,21 @@
 import numpy as np
 import pandas as pd
 import gzip
+import io
+import os
+import queue
+import threading
+import collections
 import logging
+import bgzf
+import matrix_store
+
+# threads used to decompress gzipped input ahead of the reader
+DECOMPRESS_THREADS = min(4, os.cpu_count() or 1)
+
+# size and number of decompressed chunks buffered when reading plain gzip
+READ_AHEAD_CHUNK = 1 << 20
+READ_AHEAD_DEPTH = 8
 
 
 def load_labels(input_file, tissue_idx=3, numeric=False, as_is=False):
@@ -19,31 +33,39 @@ def load_labels(input_file, tissue_idx=3, numeric=False, as_is=False):
         Tumor (where Tumor = everything not Normal) 
     """
     y = []
-    f = open_file(input_file)
-    first = True
-
     label_nums = get_labels_number_map()
 
-    for line in f:
-        if first:
-            first = False
-            continue
-        fields = line.rstrip().split('\t')
+    for tissue in read_column(input_file, tissue_idx):
         if numeric:
-            if 'Normal' in fields[tissue_idx] or 'normal' in fields[tissue_idx]:
+            if 'Normal' in tissue or 'normal' in tissue:
                 y.append(label_nums['Normal'])
             else:
                 y.append(label_nums['Tumor'])
         elif as_is:
-            y.append(fields[tissue_idx])
-        elif 'Normal' in fields[tissue_idx] or 'normal' in fields[tissue_idx]:
+            y.append(tissue)
+        elif 'Normal' in tissue or 'normal' in tissue:
             y.append('Normal')
         else:
             y.append('Tumor')
-    f.close()
     return np.array(y)
 
 
+def read_column(input_file, idx):
+    """
+    vals of metadata column idx for every sample row - straight from the 
+    metadata of a binary store, without touching probe vals
+    """
+    if matrix_store.is_store(input_file):
+        return matrix_store.MatrixStore(input_file).meta[:, idx].tolist()
+    vals = []
+    f = open_file(input_file, threads=DECOMPRESS_THREADS)
+    f.readline()
+    for line in f:
+        vals.append(line.rstrip().split('\t')[idx])
+    f.close()
+    return vals
+
+
 def num_label_for(label):
     if 'Normal' in label or 'normal' in label:
         return 1
@@ -75,9 +97,12 @@ def load_numeric_labels(input_file, tissue_idx=3):
 
 def load_file_to_matrix(input_file, cols=None, probe_start=4):
     """ Load probe alpha values into matrix """
+    if matrix_store.is_store(input_file):
+        return load_store_to_matrix(input_file, cols)
+
     # skip first three columns that have sample metadata and just keep
     # numeric vals
-    f = open_file(input_file)
+    f = open_file(input_file, threads=DECOMPRESS_THREADS)
     # peek at the first line of file to get probe labels
     # from header and figure out how many columns there are
     # so we can skip itemizing them
@@ -88,22 +113,94 @@ def load_file_to_matrix(input_file, cols=None, probe_start=4):
     if cols is None:
         num_cols = len(fields)
         labels = fields[probe_start:]
-        f.seek(0)
         cols = range(probe_start, num_cols)
     else:
         # extract out labels for probes we want
         labels = []
         for idx in cols:
             labels.append(fields[idx])
-    f.close()
-    matrix = np.genfromtxt(input_file,
+    # parse rest of already open file, header has been read
+    matrix = np.genfromtxt(f,
                            delimiter='\t',
-                           skip_header=1,
                            usecols=cols,
                            filling_values=0)
+    f.close()
+    return matrix, labels
+
+
+def load_store_to_matrix(input_file, cols=None):
+    """
+    get probe matrix straight from binary store - matrix is returned as the
+    memory mapped array unless missing vals need to be filled
+    """
+    store = matrix_store.MatrixStore(input_file)
+    if cols is None:
+        labels = list(store.probes)
+        matrix = store.matrix
+    else:
+        probe_cols = [store.column_index(idx) for idx in cols]
+        labels = [store.probes[idx] for idx in probe_cols]
+        matrix = store.matrix[:, probe_cols]
+
+    # match genfromtxt behavior of filling missing vals with 0
+    if store.has_missing:
+        matrix = np.nan_to_num(matrix, nan=0.0)
     return matrix, labels
 
 
+def parse_probe_vals(fields, missing=np.nan):
+    """
+    convert probe val strings into float array, subbing in missing val for
+    anything that doesn't parse (NA, empty, etc.)
+    """
+    try:
+        return np.array(fields, dtype=np.float64)
+    except ValueError:
+        vals = np.empty(len(fields), dtype=np.float64)
+        for i, field in enumerate(fields):
+            try:
+                vals[i] = float(field)
+            except ValueError:
+                vals[i] = missing
+        return vals
+
+
+def probe_union(probe_lists, keep_order=False):
+    """
+    sorted union of probe labels across several files - if keep_order, 
+    probes are kept in the order first seen instead (first file's order, 
+    then probes only later files have)
+    """
+    probes = {}
+    for file_probes in probe_lists:
+        probes.update(dict.fromkeys(file_probes))
+    if keep_order:
+        return list(probes)
+    return sorted(probes)
+
+
+def gather_index(file_probes, probes):
+    """
+    index array taking a file's probe columns (in file_probes order) into
+    probes order - probes the file lacks point at sentinel column 
+    len(file_probes), see gather_vals
+    """
+    file_cols = {label: i for i, label in enumerate(file_probes)}
+    sentinel = len(file_probes)
+    return np.array([file_cols.get(label, sentinel) for label in probes],
+                    dtype=np.int64)
+
+
+def gather_vals(vals, index, missing=np.nan):
+    """
+    reorder row (or samples x probes block) of vals by gather_index, 
+    filling sentinel columns with missing val
+    """
+    vals = np.asarray(vals)
+    sentinel = np.full(vals.shape[:-1] + (1,), missing, dtype=vals.dtype)
+    return np.concatenate([vals, sentinel], axis=-1)[..., index]
+
+
 def get_column_labels(input_file, cols=None, probe_start=3):
     # skip first three columns that have sample metadata and just keep
     # numeric vals
@@ -128,9 +225,21 @@ def get_column_labels(input_file, cols=None, probe_start=3):
     return labels
 
 
-def open_file(input_file):
-    """ convenience method to open regular and gzipped files """
-    if input_file.endswith('.gz'):
+def open_file(input_file, threads=1):
+    """ 
+    convenience method to open regular and gzipped files - binary matrix
+    stores are read back as 'wide' text lines. With threads > 1 (callers
+    that read the whole file pass DECOMPRESS_THREADS), gzipped files are
+    decompressed ahead of the caller on other threads: BGZF blocks in 
+    parallel across threads, plain gzip as one read-ahead stream
+    """
+    if matrix_store.is_store(input_file):
+        f = matrix_store.StoreTextReader(input_file)
+    elif input_file.endswith('.gz') and threads > 1 and bgzf.is_bgzf(input_file):
+        f = io.TextIOWrapper(bgzf.ParallelBgzfReader(input_file, threads))
+    elif input_file.endswith('.gz') and threads > 1:
+        f = io.TextIOWrapper(ReadAheadReader(gzip.open(input_file, 'rb')))
+    elif input_file.endswith('.gz'):
         f = gzip.open(input_file, 'rt')
     else:
         f = open(input_file, 'r')
@@ -138,9 +247,114 @@ def open_file(input_file):
     return f
 
 
-def open_output_file(input_file):
-    """ convenience method to open regular and gzipped files """
-    if input_file.endswith('.gz'):
+class ReadAheadReader(io.BufferedIOBase):
+    """
+    sequential reader that pulls decompressed chunks from source on a 
+    background thread (zlib releases the GIL) and hands them over through a
+    bounded queue, so decompression overlaps with parsing
+    """
+
+    def __init__(self, source, chunk_size=READ_AHEAD_CHUNK, depth=READ_AHEAD_DEPTH):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(depth)
+        self.stop = threading.Event()
+        self.done = False
+        self.error = None
+        self.data = b''
+        self.pos = 0
+        self.thread = threading.Thread(target=self._read_ahead, daemon=True)
+        self.thread.start()
+
+    def readable(self):
+        return True
+
+    def _read_ahead(self):
+        try:
+            while not self.stop.is_set():
+                chunk = self.source.read(self.chunk_size)
+                self._put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        # give up if reader is closed before chunk is taken
+        while not self.stop.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def read1(self, size=-1):
+        if self.pos >= len(self.data):
+            # worker has stopped after an error - keep raising it
+            if self.error != None:
+                raise self.error
+            if self.done:
+                return b''
+            item = self.chunks.get()
+            if isinstance(item, Exception):
+                self.error = item
+                raise item
+            if not item:
+                self.done = True
+                return b''
+            self.data = item
+            self.pos = 0
+        end = len(self.data) if size < 0 else min(len(self.data), self.pos + size)
+        chunk = self.data[self.pos:end]
+        self.pos = end
+        return chunk
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            chunk = self.read1(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        if not self.closed:
+            self.stop.set()
+            self.thread.join()
+            self.source.close()
+        super().close()
+
+
+def bounded_imap(pool, func, jobs, depth):
+    """
+    like pool.imap, yielding results in job order, but keeps at most depth
+    jobs submitted ahead of the result being consumed - imap pulls the whole
+    job iterable into its task queue up front
+    """
+    pending = collections.deque()
+    for job in jobs:
+        pending.append(pool.apply_async(func, (job,)))
+        if len(pending) >= depth:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def open_output_file(input_file, blocked=False, threads=1):
+    """ 
+    convenience method to open regular and gzipped files - if blocked, 
+    gzipped output is written as seekable block gzip (BGZF) with .gzi index.
+    With threads > 1, gzipped output is compressed block by block (BGZF, 
+    still readable as plain gzip) on background threads so compression 
+    overlaps with producing rows
+    """
+    if input_file.endswith('.gz') and (blocked or threads > 1):
+        f = io.TextIOWrapper(bgzf.BgzfWriter(input_file, write_index=blocked,
+                                             threads=threads))
+    elif input_file.endswith('.gz'):
         f = gzip.open(input_file, 'wt')
     else:
         f = open(input_file, 'w')
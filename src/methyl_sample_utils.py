@@ -1,12 +1,61 @@
 
 import matrix_utils
+import matrix_store
+import format_utils
+import numpy as np
 import sys
+from collections.abc import Mapping
 
 # column index of first probe value if demographic info not in file
 PROBE_START_IDX = 4
 
 
+class ProbeIndex(dict):
+    """
+    probe label -> column map shared by samples from one file - remembers
+    columns in sorted probe label order so it is only worked out once
+    """
+
+    def sorted_cols(self):
+        if not hasattr(self, 'order'):
+            self.order = np.array([self[p] for p in sorted(self)], dtype=np.int64)
+        return self.order
+
+
+class ProbeValues(Mapping):
+    """
+    dict-style (probe label -> val) view over a sample's row of probe vals,
+    looked up through the probe index shared by every sample from a file
+    """
+    __slots__ = ('probe_index', 'vals')
+
+    def __init__(self, probe_index, vals):
+        self.probe_index = probe_index
+        self.vals = vals
+
+    def __getitem__(self, label):
+        return float(self.vals[self.probe_index[label]])
+
+    def __setitem__(self, label, val):
+        # row has fixed columns - only probes already indexed can be set
+        self.vals[self.probe_index[label]] = val
+
+    def __iter__(self):
+        return iter(self.probe_index)
+
+    def __len__(self):
+        return len(self.probe_index)
+
+
 class MethylSample:
+    """
+    sample metadata plus probe vals held as a float32 row (usually a view 
+    into a cohort matrix) with columns given by a probe label -> column 
+    index shared across samples - probe_vals gives dict-style access
+    """
+    __slots__ = ('case', 'sample', 'biospecimen', 'tissue', 'gender', 'age',
+                 'age_group', 'stage', 'probe_index', 'vals')
+
     def __init__(self, probe_label_idxs=None, start_idx=4, line=None, required=None, missing=-1.0, required_only=False):
         """ 
         initialize sample from line if provided - use probe_label_idxs map
@@ -16,7 +65,8 @@ class MethylSample:
         """
         
         # record probe vals indexed by label
-        self.probe_vals = {}
+        self.probe_index = ProbeIndex()
+        self.vals = np.empty(0, dtype=np.float32)
         
         if line == None:
             self.case = None
@@ -39,26 +89,28 @@ class MethylSample:
                 self.age_group = fields[6]
                 self.stage = fields[7]
             
-            for i in range(start_idx, len(fields)):
-                # default missing vals to -1 to differentiate between true zero
-                label = probe_label_idxs[i]
-
-                # skip unneeded probes if limiting to required only
-                if required != None and required_only and label not in required:
-                    continue
-                    
-                try:
-                    val = float(fields[i])
-                    
-                except ValueError:
-                    val = missing
-                self.probe_vals[label] = val
-        
-            # set placeholders for any required probes not in file
-            if required != None:
-                for r in required:
-                    if r not in self.probe_vals:
-                        self.probe_vals[r] = missing
+            file_labels = [probe_label_idxs[i] for i in range(start_idx, len(fields))]
+            labels = matrix_probe_labels(file_labels, required, required_only)
+            file_cols = {label: i for i, label in enumerate(file_labels)}
+
+            # default missing vals to -1 to differentiate between true zero
+            vals = matrix_utils.parse_probe_vals(fields[start_idx:], missing=missing)
+            vals = np.append(vals, missing)
+            self.probe_index = ProbeIndex((label, i) for i, label in enumerate(labels))
+            self.vals = vals[[file_cols.get(label, len(file_labels)) 
+                              for label in labels]].astype(np.float32)
+            self.vals[np.isnan(self.vals)] = missing
+
+    @property
+    def probe_vals(self):
+        return ProbeValues(self.probe_index, self.vals)
+
+    @probe_vals.setter
+    def probe_vals(self, probe_vals):
+        labels = sorted(probe_vals.keys())
+        self.probe_index = ProbeIndex((label, i) for i, label in enumerate(labels))
+        self.vals = np.array([probe_vals[label] for label in labels], 
+                             dtype=np.float32)
           
     def __str__(self): 
         print_vals = [self.case, self.sample, self.biospecimen, self.tissue]
@@ -71,9 +123,8 @@ class MethylSample:
                                self.stage])
         
         # write probes in alphabetical order
-        for p in sorted(self.probe_vals.keys()):
-            #print_vals.append(self.sample + "_" + p)
-            print_vals.append('{0:0.7f}'.format(self.probe_vals[p]))
+        cols = self.probe_index.sorted_cols()
+        print_vals.append(format_utils.format_row(self.vals[cols]))
         return '\t'.join(print_vals)
         
 def load_probe_label_indexes(file, start_idx=4):        
@@ -99,31 +150,97 @@ def load_file_as_samples(file, required=None, start_idx=4, required_only=False):
     load wide methyl file and return as collection of MethylSamples
     
     ensure that any probes specified in required list are included in
-    sample with placeholder val if missing 
+    sample with placeholder val if missing - samples hold views into one
+    probe matrix and share a single probe index
     """
+    sample_list, labels, matrix = load_file_as_matrix(file, required=required,
+                                                      start_idx=start_idx,
+                                                      required_only=required_only)
+    probe_index = ProbeIndex((label, i) for i, label in enumerate(labels))
 
     # save with sample identifier as key referencing sample obj
     samples = {}
+    for sample, vals in zip(sample_list, matrix):
+        sample.probe_index = probe_index
+        sample.vals = vals
+        samples[sample.sample] = sample
+    return samples       
 
-    # get probe label indexes so we can refer to probes by name
-    probe_label_idxs = load_probe_label_indexes(file, start_idx=start_idx)
+def sample_from_meta(fields, start_idx=4):
+    """ make sample with metadata only from leading fields of wide file row """
+    sample = MethylSample()
+    sample.case, sample.sample, sample.biospecimen, sample.tissue = fields[:4]
+    if start_idx > 4:
+        sample.gender = fields[4]
+        sample.age = float(fields[5])
+        sample.age_group = fields[6]
+        sample.stage = fields[7]
+    return sample
 
-    # open file and read past header line
-    f = matrix_utils.open_file(file)
-    f.readline()
-    
-    # convert all others into methyl sample
-    counter = 0
+def matrix_probe_labels(file_labels, required=None, required_only=False):
+    """
+    sorted probe labels a loaded matrix will have - same set and order as
+    matrix_utils.get_header_from_file writes
+    """
+    if required != None and required_only:
+        return sorted(required)
+    labels = set(file_labels)
+    if required != None:
+        labels.update(required)
+    return sorted(labels)
+
+def load_file_as_matrix(file, required=None, start_idx=4, required_only=False,
+                        missing=-1.0, dtype=np.float32):
+    """
+    load wide methyl file as list of samples (metadata only) plus a dtype
+    (samples x probes) matrix of probe vals with columns in sorted probe 
+    label order shared by all samples. Missing and required-but-absent
+    probes get missing val. With dtype float64, vals equal those parsed
+    from the text file (store vals are rounded back to the written decimals)
+    """
+    if matrix_store.is_store(file):
+        store = matrix_store.MatrixStore(file)
+        file_labels = store.probes
+    else:
+        f = matrix_utils.open_file(file)
+        file_labels = f.readline().rstrip('\n').split('\t')[start_idx:]
+
+    labels = matrix_probe_labels(file_labels, required, required_only)
+
+    # gather index from file probe order into sorted order - probes not in
+    # file point at sentinel column holding missing val
+    gather = matrix_utils.gather_index(file_labels, labels)
+    sentinel = len(file_labels)
+
+    samples = []
+    if matrix_store.is_store(file):
+        present = gather != sentinel
+        matrix = np.full((len(store), len(labels)), missing, dtype=dtype)
+        matrix[:, present] = store.matrix[:, gather[present]]
+        if matrix.dtype != np.float32:
+            scale = 10 ** format_utils.PRECISION
+            matrix = np.rint(matrix * scale) / scale
+        matrix[np.isnan(matrix)] = missing
+        samples = [sample_from_meta(fields, start_idx) 
+                   for fields in store.meta.tolist()]
+        return samples, labels, matrix
+
+    rows = []
     for line in f:
         if line.strip() == "":
             continue
-        counter += 1
-        if counter % 100 == 0:
-            print(f'{counter} lines loaded', file=sys.stderr)
-        sample = MethylSample(probe_label_idxs, start_idx=start_idx, line=line, required=required, required_only=required_only)
-        samples[sample.sample] = sample
-    f.close()    
-    return samples       
+        if (len(rows) + 1) % 100 == 0:
+            print(f'{len(rows) + 1} lines loaded', file=sys.stderr)
+        fields = line.rstrip('\n').split('\t')
+        vals = matrix_utils.parse_probe_vals(fields[start_idx:], missing=missing)
+        row = matrix_utils.gather_vals(vals, gather, missing).astype(dtype)
+        row[np.isnan(row)] = missing
+        rows.append(row)
+        samples.append(sample_from_meta(fields, start_idx))
+    f.close()
+
+    matrix = np.vstack(rows) if rows else np.empty((0, len(labels)), dtype)
+    return samples, labels, matrix
 
 def get_age_group(age):
     """function to encapsulate assignment of age to our pre-defined age groups"""
@@ -225,6 +342,40 @@ def match_by_demographics(samples, age, gender):
             matched[sample_id] = sample
     return matched
 
+class DemographicStrata:
+    """
+    normal cohort bucketed once by (age group, gender) - samples and their
+    matrix rows are reordered so each stratum is a contiguous row range,
+    making demographic matching a dict lookup and random picks index draws
+    """
+
+    def __init__(self, samples, rows, matrix):
+        """
+        samples = dict of sample id referencing sample with age and gender,
+        rows = dict of sample id referencing row of matrix
+        """
+        def stratum(sample_id):
+            sample = samples[sample_id]
+            return (get_age_group(sample.age), sample.gender)
+
+        # stable sort keeps input order within each stratum
+        ordered = sorted(samples.keys(), key=stratum)
+        self.samples = [samples[sample_id] for sample_id in ordered]
+        self.matrix = matrix[[rows[sample_id] for sample_id in ordered]]
+
+        self.ranges = {}
+        for i, sample_id in enumerate(ordered):
+            key = stratum(sample_id)
+            start, _ = self.ranges.get(key, (i, i))
+            self.ranges[key] = (start, i + 1)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def match(self, age, gender):
+        """ row range (start, end) of samples matching age group and gender """
+        return self.ranges.get((get_age_group(age), gender), (0, 0))
+
 def filter_by_demographics(samples, min_age):
     """
     filter sample set to remove samples with no demographic metadata and
@@ -241,10 +392,9 @@ def filter_by_demographics(samples, min_age):
 
 def write_samples_to_file(samples, file_name, header):
     """
-    write submitted samples to a tmp file - this
-    is done to persist subsets of samples temporarily so that they can
-    be processed in multiple threads without having to copy the entire dataset
-    between processes (as python multiprocessing does)
+    write submitted samples to a file - parallel simulate and mix don't go 
+    through temp files, workers share the sample matrix (forked or shared 
+    memory) instead of having it copied between processes
     """
     f = matrix_utils.open_output_file(file_name)
     print(header, file=f)
@@ -6,6 +6,10 @@ import sys
 import gzip
 import argparse
 import matrix_utils
+import matrix_index
+import matrix_store
+import format_utils
+import numpy as np
 
 def parse_args():
     parser = argparse.ArgumentParser(description='print value of matrix cell',
@@ -22,9 +26,46 @@ def parse_args():
     args = parser.parse_args()
     return args
 
+def print_indexed_cell(index, args):
+    """ seek straight to requested row using sidecar index """
+    col_idx = index.column_for(args.column)
+    print(f"col idx: {col_idx} for {args.column}", file=sys.stderr)
+    for line in index.read_rows(index.rows_for({args.row})[:1]):
+        fields = line.rstrip('\n').split('\t')
+        print(f"\t{args.column}")
+        print(f"{args.row}\t{fields[col_idx]}")
+
+def print_store_cell(args):
+    """ look cell up in store metadata and matrix without rendering rows """
+    store = matrix_store.MatrixStore(args.input)
+    if args.column not in store.header:
+        raise Exception("col header not found: " + args.column)
+    col_idx = store.header.index(args.column)
+    print(f"col idx: {col_idx} for {args.column}", file=sys.stderr)
+    rows = np.flatnonzero(store.meta[:, 0] == args.row)
+    if len(rows) == 0:
+        return
+    if col_idx < store.probe_start_idx:
+        val = store.meta[rows[0], col_idx]
+    else:
+        val = format_utils.format_row(store.matrix[rows[0], 
+                                                   store.column_index(col_idx)], 
+                                      na='NA')
+    print(f"\t{args.column}")
+    print(f"{args.row}\t{val}")
+
 def main():
     args = parse_args()
+
+    if matrix_store.is_store(args.input):
+        print_store_cell(args)
+        return
     
+    index = matrix_index.load_index(args.input)
+    if index != None:
+        print_indexed_cell(index, args)
+        return
+
     # assume first line of file is headers and first column is labels
     f = matrix_utils.open_file(args.input)
         
@@ -0,0 +1,252 @@
+"""
+Running per-probe descriptive statistics that can be computed in a single
+streaming pass and merged across partial results
+"""
+
+import json
+import numpy as np
+
+# accumulators are saved next to stats output as <output>.state
+STATE_SUFFIX = '.state'
+
+# arrays that make up the saved state of ProbeMoments
+ACCUMULATORS = ['count', 'mean', 'm2', 'minimum', 'maximum', 'missing']
+
+# smallest level capacity of quantile sketch (same as DataSketches KLL)
+MIN_CAPACITY = 8
+
+
+class ProbeMoments:
+    """
+    running count, mean, sum of squared deviations (M2), min, max and missing
+    count for every probe at once - rows are folded in blocks using Chan et
+    al.'s parallel update so two partial results merge exactly
+    """
+
+    def __init__(self, num_probes):
+        self.count = np.zeros(num_probes, dtype=np.int64)
+        self.mean = np.zeros(num_probes, dtype=np.float64)
+        self.m2 = np.zeros(num_probes, dtype=np.float64)
+        self.minimum = np.full(num_probes, np.inf, dtype=np.float64)
+        self.maximum = np.full(num_probes, -np.inf, dtype=np.float64)
+        self.missing = np.zeros(num_probes, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.count)
+
+    def update(self, block):
+        """
+        fold block of rows (samples x probes) into running stats - NaN
+        entries are skipped
+        """
+        block = np.asarray(block, dtype=np.float64)
+        present = ~np.isnan(block)
+        count = present.sum(axis=0)
+        filled = np.where(present, block, 0.0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, filled.sum(axis=0) / count, 0.0)
+        m2 = (np.where(present, block - mean, 0.0) ** 2).sum(axis=0)
+        minimum = np.where(present, block, np.inf).min(axis=0)
+        maximum = np.where(present, block, -np.inf).max(axis=0)
+        self._combine(count, mean, m2, minimum, maximum)
+
+    def merge(self, other):
+        """ fold in partial stats gathered over a different set of rows """
+        self._combine(other.count, other.mean, other.m2, other.minimum,
+                      other.maximum)
+        self.missing += other.missing
+
+    def _combine(self, count, mean, m2, minimum, maximum):
+        total = self.count + count
+        delta = mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(total > 0, count / total, 0.0)
+        self.mean += delta * weight
+        self.m2 += m2 + delta ** 2 * self.count * weight
+        self.count = total
+        np.minimum(self.minimum, minimum, out=self.minimum)
+        np.maximum(self.maximum, maximum, out=self.maximum)
+
+    def add_missing(self, missing):
+        """ record count of missing vals seen per probe """
+        self.missing += missing
+
+    def variance(self):
+        """ sample variance (n - 1), NaN if fewer than two vals """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)
+
+    def stdev(self):
+        return np.sqrt(self.variance())
+
+    def reorder(self, order):
+        """ rearrange probes so position i holds current probe order[i] """
+        for name in ACCUMULATORS:
+            setattr(self, name, getattr(self, name)[order])
+
+
+class QuantileSketch:
+    """
+    bounded memory, mergeable streaming quantile sketch (KLL) kept for every
+    probe at once. Every row adds one item per probe, so all probes share the
+    same level layout and each level is a single (probes x items) array that
+    is compacted with one vectorized sort.
+
+    Sketch holds about 3k items per probe and is exact until a probe has
+    seen more than k vals. Levels follow the layout of the Apache 
+    DataSketches KLL sketch (capacity k shrinking by 2/3 per level down to
+    MIN_CAPACITY), whose published rank error at 99% confidence is about
+    2.3 / k^0.97 of the number of vals seen - about 2.1% for the default
+    k=128. NaN entries are carried along but get no weight in estimates.
+    Pass a seed to make compaction (and so the estimates) reproducible.
+    """
+
+    def __init__(self, num_probes, k=128, seed=None):
+        self.num_probes = num_probes
+        self.k = k
+        self.rng = np.random.default_rng(seed)
+        self.levels = [np.empty((num_probes, 0), dtype=np.float32)]
+
+    def capacity(self, level):
+        """ capacity shrinks geometrically (2/3) below the top level """
+        depth = len(self.levels) - level - 1
+        return max(MIN_CAPACITY, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def update(self, block):
+        """ add block of rows (samples x probes) to sketch """
+        block = np.asarray(block, dtype=np.float32)
+        self.levels[0] = np.hstack([self.levels[0], block.T])
+        self._compress()
+
+    def merge(self, other):
+        """ fold in sketch built over a different set of rows """
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(items.copy())
+            else:
+                self.levels[level] = np.hstack([self.levels[level], items])
+        self._compress()
+
+    def _compress(self):
+        """ compact lowest over capacity level until all levels fit """
+        level = 0
+        while level < len(self.levels):
+            if self.levels[level].shape[1] > self.capacity(level):
+                self._compact(level)
+                # top level may have been added, recheck from the bottom
+                level = 0
+            else:
+                level += 1
+
+    def _compact(self, level):
+        """
+        sort level and promote every other item (random parity) to the next
+        level with double weight - odd item out stays behind
+        """
+        items = np.sort(self.levels[level], axis=1)
+        paired = items.shape[1] - items.shape[1] % 2
+        offset = self.rng.integers(2)
+        promoted = items[:, offset:paired:2]
+        self.levels[level] = items[:, paired:]
+        if level + 1 == len(self.levels):
+            self.levels.append(promoted)
+        else:
+            self.levels[level + 1] = np.hstack([self.levels[level + 1], promoted])
+
+    def reorder(self, order):
+        """ rearrange probes so position i holds current probe order[i] """
+        self.levels = [level[order] for level in self.levels]
+
+    def quantiles(self, qs, chunk_size=10000):
+        """
+        estimate quantiles qs (0-1) for every probe, returned as 
+        (len(qs) x probes) array - NaN where probe has no vals
+        """
+        items = np.hstack(self.levels)
+        weights = np.concatenate([np.full(lvl.shape[1], 2 ** level, dtype=np.int64)
+                                  for level, lvl in enumerate(self.levels)])
+        estimates = np.full((len(qs), self.num_probes), np.nan)
+        if items.shape[1] == 0:
+            return estimates
+
+        # work through probes in chunks to bound the sort buffers
+        for start in range(0, self.num_probes, chunk_size):
+            chunk = items[start:start + chunk_size]
+            order = np.argsort(chunk, axis=1)
+            vals = np.take_along_axis(chunk, order, axis=1)
+            cumulative = np.cumsum(np.where(np.isnan(vals), 0, weights[order]), 
+                                   axis=1)
+            total = cumulative[:, -1]
+            for i, q in enumerate(qs):
+                # first item whose cumulative weight reaches q of the total
+                idx = np.argmax(cumulative >= q * total[:, None], axis=1)
+                found = np.take_along_axis(vals, idx[:, None], axis=1)[:, 0]
+                estimates[i, start:start + chunk_size] = np.where(total > 0, 
+                                                                  found, np.nan)
+        return estimates
+
+
+class ProbeStats:
+    """ running moments plus optional quantile sketch for all probes """
+
+    def __init__(self, num_probes, sketch_k=None, seed=None):
+        self.moments = ProbeMoments(num_probes)
+        self.sketch = None
+        if sketch_k != None:
+            self.sketch = QuantileSketch(num_probes, k=sketch_k, seed=seed)
+
+    def update(self, block):
+        self.moments.update(block)
+        if self.sketch != None:
+            self.sketch.update(block)
+
+    def add_missing(self, missing):
+        self.moments.add_missing(missing)
+
+    def merge(self, other):
+        self.moments.merge(other.moments)
+        if self.sketch != None:
+            self.sketch.merge(other.sketch)
+
+    def reorder(self, order):
+        self.moments.reorder(order)
+        if self.sketch != None:
+            self.sketch.reorder(order)
+
+
+def state_path(file):
+    return file + STATE_SUFFIX
+
+
+def save_state(file, probes, stats, settings):
+    """
+    save accumulators (plus probe labels and settings used to build them) so
+    stats can later be updated with new rows
+    """
+    arrays = {name: getattr(stats.moments, name) for name in ACCUMULATORS}
+    if stats.sketch != None:
+        settings = dict(settings, sketch_k=stats.sketch.k)
+        for level, items in enumerate(stats.sketch.levels):
+            arrays[f'level_{level}'] = items
+    with open(file, 'wb') as f:
+        np.savez(f, probes=np.array(probes, dtype=str),
+                 settings=np.array(json.dumps(settings)), **arrays)
+
+
+def load_state(file, seed=None):
+    """
+    load saved accumulators - returns probe labels, stats and settings. seed
+    drives compaction of any rows later merged into the sketch
+    """
+    with np.load(file) as data:
+        probes = data['probes'].tolist()
+        settings = json.loads(str(data['settings']))
+        stats = ProbeStats(len(probes), sketch_k=settings.get('sketch_k'),
+                           seed=seed)
+        for name in ACCUMULATORS:
+            setattr(stats.moments, name, data[name])
+        if stats.sketch != None:
+            levels = sorted((k for k in data.files if k.startswith('level_')),
+                            key=lambda k: int(k.split('_')[1]))
+            stats.sketch.levels = [data[k] for k in levels]
+    return probes, stats, settings
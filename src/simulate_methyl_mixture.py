@@ -23,10 +23,19 @@ with metadata file for both SRA and TCGA
 
 import sys
 import argparse
+import multiprocessing
 import matrix_utils
+import matrix_store
 import methyl_sample_utils as m_utils
-import random
 import simulation_noise
+import format_utils
+import numpy as np
+
+#FIXME: parameterize missing val
+MISSING_VAL = -1.0
+
+# tumors queued per worker process ahead of the one being written
+TUMORS_PER_WORKER = 4
 
 def parse_args():
     parser = argparse.ArgumentParser(description='create simulated cell-free ' + 
@@ -43,8 +52,11 @@ def parse_args():
     parser.add_argument('-o', '--output', type=str, 
                         help='output file to write [default=STDOUT]')
     
-    parser.add_argument('-f', '--tumor_fraction', type=float, required=True, 
-                        help='fraction of tumor signal in output (total=1)')
+    parser.add_argument('-f', '--tumor_fraction', type=parse_fractions, 
+                        required=True, 
+                        help='fraction of tumor signal in output (total=1) - ' +
+                        'comma separated list or start:stop:step range to ' +
+                        'mix at several fractions in one pass')
 
     parser.add_argument('-m', '--normal_metadata', type=str, 
                         help='metadata file with age and gender for normals')
@@ -91,68 +103,297 @@ def parse_args():
     
 
     
+    parser.add_argument('-b', '--block_size', type=int, default=16,
+                        help='number of normals mixed with each tumor at ' +
+                        'once in all by all mode [default=16]')
+
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of worker processes to mix tumors ' +
+                        'with [default=1]')
+
+    parser.add_argument('--seed', type=int,
+                        help='random seed - output is identical for a given ' +
+                        'seed regardless of workers [default=random, logged]')
+
+    parser.add_argument('--precision', type=int, default=format_utils.PRECISION,
+                        help='number of decimals written for probe vals ' +
+                        f'[default={format_utils.PRECISION}]')
+
+    parser.add_argument('--bgzf', action='store_true',
+                        help='write gzipped output as seekable block gzip (BGZF)')
+
+    parser.add_argument('--compress_threads', type=int, default=1,
+                        help='threads compressing gzipped output in the ' +
+                        'background [default=1]')
+
     args = parser.parse_args()
     return args
 
 
-def adjust_vals(normal, tumor, normal_fraction, tumor_fraction, probes=None):
-    adjusted = {}
-    
-    for probe_label in normal.keys():
-        adjusted_normal = normal[probe_label] * normal_fraction
-        adjusted_tumor = tumor[probe_label] * tumor_fraction
-        combined_val = (adjusted_normal + adjusted_tumor)
+def parse_fractions(val):
+    """
+    parse tumor fraction argument - single fraction, comma separated list 
+    (0.001,0.005,0.01) or inclusive range start:stop:step (0.01:0.1:0.01)
+    """
+    try:
+        if ':' in val:
+            start, stop, step = [float(v) for v in val.split(':')]
+        else:
+            fractions = [float(v) for v in val.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('tumor fraction must be a number, ' +
+                                         'comma separated list or ' +
+                                         'start:stop:step range: ' + val)
+    if ':' in val:
+        if step <= 0:
+            raise argparse.ArgumentTypeError('tumor fraction range step must ' +
+                                             'be greater than 0: ' + val)
+        if stop < start:
+            raise argparse.ArgumentTypeError('tumor fraction range stop must ' +
+                                             'not be less than start: ' + val)
+        num = int(round((stop - start) / step)) + 1
+        fractions = [round(start + i * step, 10) for i in range(num)]
+    for fraction in fractions:
+        if fraction < 0 or fraction > 1:
+            raise argparse.ArgumentTypeError('tumor fraction must be between ' +
+                                             f'0 and 1: {fraction:g}')
+    return np.array(fractions, dtype=np.float64)
+
+
+def adjust_vals(normal, tumor, tumor_fractions, model, rng):
+    """
+    blend block of normals (normals x probes) with tumor probe vals at every
+    tumor fraction in one broadcast - returns (normals * fractions x probes)
+    array of (Fn x Bn) + (Ft x Bt) with noise, normal-major
+    """
+    normal = np.atleast_2d(normal)
+    fractions = tumor_fractions[None, :, None]
+    blended = (1 - fractions) * normal[:, None, :] + fractions * tumor[None, None, :]
+    blended = blended.reshape(-1, normal.shape[1])
         
-        # simulate random noise if probes provided
+    # simulate random noise for probes in model
         # randomly simulate sv
         # randomly simulate confounding snp
         # simulate random noise based off of stdev
         # adjust aggregate probe val accordingly
-        if probes != None and probe_label in probes:
-            probe = probes[probe_label]
-            
-            # negative values signal missing probe data in one or more
-            # samples used to create simulated sample -- skip adjustment
-            # in this case and print missing val (-1) for this probe
-            if combined_val >= 0:
-                combined_val = simulation_noise.random_adjust(combined_val, probe)
-                adjusted[probe_label] = combined_val
-            else:
-                #FIXME: parameterize missing val
-                adjusted[probe_label] = -1
-        else:
-            adjusted[probe_label] = combined_val
-        
-        
-    return adjusted
+    # negative values signal missing probe data in one or more
+    # samples used to create simulated sample -- skip adjustment
+    # in this case and print missing val (-1) for this probe
+    return model.apply(blended, rng, adjust_zero=True)
 
 
-def combine(normal, tumor, normal_fraction, tumor_fraction, probes=None):
-    combined = m_utils.MethylSample()        
-    
-    normal_fraction_str = '{0:0.3f}'.format(normal_fraction)
+def combined_meta(normal, tumor, tumor_fraction):
+    """ metadata columns for normal/tumor mixture at tumor fraction """
+    normal_fraction_str = '{0:0.3f}'.format(1 - tumor_fraction)
     tumor_fraction_str = '{0:0.3f}'.format(tumor_fraction)
 
-    combined.case = 'ct-sim'
-    combined.sample = normal.case + "_" + tumor.case
-    combined.biospecimen = normal_fraction_str + ":" + tumor_fraction_str
-    combined.tissue = 'tumor'
-    print(f'creating simulated sample {combined.sample}', file=sys.stderr)
-    combined.probe_vals = adjust_vals(normal.probe_vals, tumor.probe_vals,normal_fraction, tumor_fraction,probes=probes)
+    sample_label = normal.case + "_" + tumor.case
+    print_vals = ['ct-sim', sample_label, 
+                  normal_fraction_str + ":" + tumor_fraction_str, 'tumor']
     
     if hasattr(tumor, 'gender'):
-        combined.gender = tumor.gender
-        combined.age = tumor.age
-        combined.stage = tumor.stage
+        print_vals.extend([tumor.gender, str(tumor.age), 
+                           m_utils.get_age_group(tumor.age), tumor.stage])
+    return '\t'.join(print_vals)
+
+
+def combine(normals, normal_vals, tumor, tumor_vals, tumor_fractions, model, 
+            rng, precision=format_utils.PRECISION):
+    """ 
+    make combined samples for block of normals (rows of normal_vals) with 
+    tumor at every tumor fraction - returns formatted output lines
+    """
+    print(f'creating {len(normals) * len(tumor_fractions)} simulated samples ' +
+          f'{normals[0].case}..{normals[-1].case}_{tumor.case}', file=sys.stderr)
+    vals = adjust_vals(normal_vals, tumor_vals, tumor_fractions, model, rng)
+    rows = format_utils.format_rows(vals, precision=precision)
+    lines = []
+    for i, row in enumerate(rows):
+        normal = normals[i // len(tumor_fractions)]
+        tumor_fraction = tumor_fractions[i % len(tumor_fractions)]
+        lines.append(combined_meta(normal, tumor, tumor_fraction) + '\t' + 
+                     row + '\n')
+    return ''.join(lines)
+
+
+class TumorMixer:
+    """
+    everything needed to mix any single tumor line with its normals on its 
+    own - tumor number t draws from an RNG seeded with (seed, t), so output 
+    doesn't depend on which process mixes which tumor
+    """
+
+    def __init__(self, normal_list, normal_matrix, normals, tumor_metadata,
+                 gather, start_idx, tumor_fractions, model, seed, 
+                 all_by_all=False, block_size=16, 
+                 precision=format_utils.PRECISION):
+        self.normal_list = normal_list
+        self.normal_matrix = normal_matrix
+        self.normals = normals
+        self.tumor_metadata = tumor_metadata
+        self.gather = gather
+        self.start_idx = start_idx
+        self.tumor_fractions = tumor_fractions
+        self.model = model
+        self.seed = seed
+        self.all_by_all = all_by_all
+        self.block_size = block_size
+        self.precision = precision
+
+    def mix(self, job):
+        """
+        mix one (tumor number, tumor row) job and return formatted output
+        lines plus dropout event counts - row is a text line, or (metadata 
+        fields, vals) read straight from a binary store
+        """
+        tumor_number, row = job
+        rng = np.random.default_rng(np.random.SeedSequence(self.seed, 
+                                                           spawn_key=(tumor_number,)))
+        sv_before = self.model.sv_dropouts
+        snp_before = self.model.snp_dropouts
+
+        if isinstance(row, str):
+            fields = row.rstrip('\n').split('\t')
+            vals = matrix_utils.parse_probe_vals(fields[self.start_idx:], 
+                                                 missing=MISSING_VAL)
+        else:
+            fields, vals = row
+        tumor = m_utils.sample_from_meta(fields, self.start_idx)
+        tumor_vals = np.append(vals, MISSING_VAL)[self.gather]
+        tumor_vals[np.isnan(tumor_vals)] = MISSING_VAL
+        start, end = 0, len(self.normal_list)
+        
+        if self.tumor_metadata:
+            
+            age,_,gender,stage = self.tumor_metadata[tumor.case]
+            tumor.age = int(age)
+            tumor.gender = gender
+            tumor.stage = stage
+            
+            start, end = self.normals.match(tumor.age, tumor.gender)
+            if start == end:
+                print(f'No normal matches found for tumor sample: {tumor.age}|{tumor.gender}',
+                       file=sys.stderr)
+                return '', 0, 0
+        
+        # if desired, choose a single random sample to mix with 
+        if self.all_by_all:
+            blocks = [(block, min(block + self.block_size, end)) 
+                      for block in range(start, end, self.block_size)]
+        else:
+            row = int(rng.integers(start, end))
+            blocks = [(row, row + 1)]
+
+        text = ''.join(combine(self.normal_list[block:block_end], 
+                               self.normal_matrix[block:block_end], 
+                               tumor, tumor_vals, self.tumor_fractions, 
+                               self.model, rng, precision=self.precision)
+                       for block, block_end in blocks)
+        return (text, 
+                self.model.sv_dropouts - sv_before,
+                self.model.snp_dropouts - snp_before)
+
+
+# mixer shared with forked worker processes (inherited, not pickled)
+_mixer = None
+
+def _mix_tumor(job):
+    return _mixer.mix(job)
+
+def read_tumor_jobs(tumor_file):
+    """
+    yield (tumor number, row) for every tumor row to be mixed - text lines
+    are parsed by the mixer, store rows come parsed from the matrix
+    """
+    if matrix_store.is_store(tumor_file):
+        yield from read_store_tumor_jobs(tumor_file)
+        return
+    f = matrix_utils.open_file(tumor_file, threads=matrix_utils.DECOMPRESS_THREADS)
+    counter = 0
+    for line in f:
+        if line.startswith('case'):
+            continue
+        elif 'Metastatic' in line:
+            continue
+        counter += 1
+        if counter % 10 == 0:
+            print(f"{counter} tumor lines read", file=sys.stderr)
+        yield counter, line
+    f.close()
+
+def read_store_tumor_jobs(tumor_file):
+    """ yield (tumor number, (metadata fields, vals)) for store rows """
+    store = matrix_store.MatrixStore(tumor_file)
+    counter = 0
+    for i, fields in enumerate(store.meta.tolist()):
+        if any('Metastatic' in field for field in fields):
+            continue
+        counter += 1
+        if counter % 10 == 0:
+            print(f"{counter} tumor lines read", file=sys.stderr)
+        yield counter, (fields, store.text_vals(i, i + 1)[0])
+
+def mix_tumors(mixer, tumor_file, out_file, workers=1):
+    """
+    mix every tumor line in tumor_file, fanning tumors out across worker 
+    processes - output is written in tumor order either way. Forked workers
+    share the parent's normal matrix pages copy-on-write (it is only read),
+    and only a few tumors per worker are read ahead of the output
+    """
+    global _mixer
+
+    jobs = read_tumor_jobs(tumor_file)
+    pool = None
+    try:
+        if workers > 1:
+            _mixer = mixer
+            pool = multiprocessing.get_context('fork').Pool(workers)
+            results = matrix_utils.bounded_imap(pool, _mix_tumor, jobs,
+                                                workers * TUMORS_PER_WORKER)
+        else:
+            results = map(mixer.mix, jobs)
+
+        for text, sv_dropouts, snp_dropouts in results:
+            out_file.write(text)
+            if workers > 1:
+                # dropout counts happened in worker copies of the model
+                mixer.model.sv_dropouts += sv_dropouts
+                mixer.model.snp_dropouts += snp_dropouts
+    finally:
+        if pool != None:
+            pool.terminate()
+            pool.join()
+        _mixer = None
+
+
+def tumor_gather_index(tumor_file, start_idx, labels, required):
+    """
+    index from tumor row probe fields into shared (normal) probe order - 
+    required probes absent from tumor point at sentinel missing column
+    """
+    f = matrix_utils.open_file(tumor_file)
+    tumor_labels = f.readline().rstrip('\n').split('\t')[start_idx:]
+    f.close()
+    tumor_cols = {label: i for i, label in enumerate(tumor_labels)}
+    sentinel = len(tumor_labels)
+    gather = []
+    for label in labels:
+        if label in tumor_cols:
+            gather.append(tumor_cols[label])
+        elif required != None and label in required:
+            gather.append(sentinel)
+        else:
+            raise Exception('normal probe not in tumor file: ' + label)
+    return np.array(gather, dtype=np.int64)
 
-    return combined
 
 def main():
     args = parse_args()
     
     out_file = sys.stdout
     if (args.output):
-        out_file = matrix_utils.open_output_file(args.output)
+        out_file = matrix_utils.open_output_file(args.output, blocked=args.bgzf,
+                                                 threads=args.compress_threads)
         
     if args.all_by_all:
         print('simulating all x all', file=sys.stderr)
@@ -188,10 +429,18 @@ def main():
         probe_subset = matrix_utils.load_probe_list(args.probes)
     
     print(f"reading normal from {args.normal}", file=sys.stderr)
-    all_normal_samples = m_utils.load_file_as_samples(args.normal, 
-                                                      start_idx=args.normal_probe_start_idx,
-                                                     required=probe_subset, 
-                                                     required_only=(probe_subset != None))    
+    # float64 so blends match mixing the parsed text vals exactly
+    normal_list, labels, normal_matrix = m_utils.load_file_as_matrix(args.normal, 
+                                                                     start_idx=args.normal_probe_start_idx,
+                                                                     required=probe_subset, 
+                                                                     required_only=(probe_subset != None),
+                                                                     dtype=np.float64)    
+    # keyed by sample id (last row wins for repeats) referencing matrix row
+    all_normal_samples = {}
+    normal_rows = {}
+    for row, sample in enumerate(normal_list):
+        all_normal_samples[sample.sample] = sample
+        normal_rows[sample.sample] = row
             
     tumor_metadata = None       
     if args.demographic:
@@ -215,11 +464,35 @@ def main():
     
     print(f"{len(all_normal_samples)} normal lines read", file=sys.stderr)
 
-    normal_fraction = 1 - args.tumor_fraction
-
+    # bucket normals by demographics once so matching is a lookup - without
+    # matching, every normal is in one range
+    normals = None
+    if tumor_metadata:
+        normals = m_utils.DemographicStrata(all_normal_samples, normal_rows, 
+                                            normal_matrix)
+        print(f'{len(normals.ranges)} demographic strata', file=sys.stderr)
+        normal_list = normals.samples
+        normal_matrix = normals.matrix
+    else:
+        normal_list = list(all_normal_samples.values())
+        order = [normal_rows[s.sample] for s in normal_list]
+        # only repeated samples move rows - skip the copy otherwise
+        if order != list(range(len(normal_matrix))):
+            normal_matrix = normal_matrix[order]
+
+    tumor_fractions = args.tumor_fraction
+    print(f'mixing at tumor fractions: {tumor_fractions.tolist()}', file=sys.stderr)
+
+    seed = args.seed
+    if seed == None:
+        seed = np.random.SeedSequence().entropy
+    print(f'random seed: {seed}', file=sys.stderr)
+
+    model = simulation_noise.NoiseModel(probes, labels)
     
-    # get probe label indexes to enable referring to them by name
-    probe_label_idxs = m_utils.load_probe_label_indexes(args.tumor, start_idx=args.tumor_probe_start_idx)
+    # map tumor probe fields onto normal probe order
+    gather = tumor_gather_index(args.tumor, args.tumor_probe_start_idx, labels,
+                                probe_subset)
     
     header = matrix_utils.get_header_from_file(args.tumor, 
                                                (tumor_metadata != None),
@@ -228,56 +501,14 @@ def main():
                                                required_only=(probe_subset != None))
     print(header, file=out_file)
 
-    
-    # input files are rows = samples, cols = probe vals
-    # open file and read past header
-    f = matrix_utils.open_file(args.tumor)
-    counter = 0
-    for line in f:
-        if line.startswith('case'):
-            continue
-        elif 'Metastatic' in line:
-            continue
-        counter += 1
-        if counter % 10 == 0:
-            print(f"{counter} tumor lines read", file=sys.stderr)
-        
-        tumor = m_utils.MethylSample(line=line, 
-                                     probe_label_idxs=probe_label_idxs, 
-                                     start_idx=args.tumor_probe_start_idx,
-                                     required=probe_subset, 
-                                     required_only=(probe_subset != None))
-        normal_samples = all_normal_samples
-        
-        if tumor_metadata:
-            
-            age,_,gender,stage = tumor_metadata[tumor.case]
-            tumor.age = int(age)
-            tumor.gender = gender
-            tumor.stage = stage
-            
-            normal_samples = m_utils.match_by_demographics(all_normal_samples,
-                                                           tumor.age,
-                                                           tumor.gender)
-            num_samples = len(normal_samples)
-            if num_samples == 0:
-                print(f'No normal matches found for tumor sample: {tumor.age}|{tumor.gender}',
-                       file=sys.stderr)
-                continue
-        
-        # if desired, choose a single random sample to mix with 
-        if args.all_by_all:
-            for normal_label, normal in normal_samples.items():
-                combined = combine(normal, tumor, normal_fraction, args.tumor_fraction, probes=probes)
-                print(combined, file=out_file)
-        else:
-            normal_label = random.choice(list(normal_samples.keys()))
-            normal = normal_samples[normal_label]
-            
-            combined = combine(normal, tumor, normal_fraction, args.tumor_fraction, probes=probes)
-            print(combined, file=out_file)
+    mixer = TumorMixer(normal_list, normal_matrix, normals, tumor_metadata,
+                       gather, args.tumor_probe_start_idx, tumor_fractions,
+                       model, seed, all_by_all=args.all_by_all, 
+                       block_size=args.block_size, precision=args.precision)
+    mix_tumors(mixer, args.tumor, out_file, workers=args.workers)
      
     out_file.close()
+    print(model.dropout_summary(), file=sys.stderr)
     
     
     
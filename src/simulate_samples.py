@@ -24,8 +24,21 @@ import argparse
 import matrix_utils
 import methyl_sample_utils as m_utils
 import simulation_noise
-import itertools
+import combination_utils
+import format_utils
+import multiprocessing
 import statistics
+import numpy as np
+
+# number of combinations simulated together
+BATCH_SIZE = 32
+
+# batches queued per worker process ahead of the one being written
+BATCHES_PER_WORKER = 4
+
+# spawn keys for independent random streams derived from the run seed
+NOISE_STREAM = 0
+SAMPLING_STREAM = 1
 
 def parse_args():
     parser = argparse.ArgumentParser(description='create simulated methylation ' +
@@ -88,96 +101,237 @@ def parse_args():
                         'than this [default=.3]')
     
     
+    parser.add_argument('-d', '--random_sample', action='store_true',
+                        help='draw max_individuals combinations uniformly at ' +
+                        'random instead of taking the first ones [default=false]')
+
+    parser.add_argument('-u', '--unique', action='store_true',
+                        help='never draw the same combination twice when ' +
+                        'sampling at random [default=false]')
+
+    parser.add_argument('-g', '--revolving_door', action='store_true',
+                        help='visit combinations in revolving door order (one ' +
+                        'sample swapped per step) and update running means ' +
+                        'incrementally - faster for exhaustive runs with k >= 4')
+
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of processes to simulate combinations ' +
+                        'across [default=1]')
+
+    parser.add_argument('--seed', type=int,
+                        help='random seed - output is identical for a given ' +
+                        'seed regardless of workers [default=random, logged]')
+
+    parser.add_argument('--precision', type=int, default=format_utils.PRECISION,
+                        help='number of decimals written for probe vals ' +
+                        f'[default={format_utils.PRECISION}]')
+
+    parser.add_argument('--bgzf', action='store_true',
+                        help='write gzipped output as seekable block gzip (BGZF)')
+
+    parser.add_argument('--compress_threads', type=int, default=1,
+                        help='threads compressing gzipped output in the ' +
+                        'background [default=1]')
+
     args = parser.parse_args()
     return args
 
 
-def make_combinations(samples, k, with_replacement, out_file, max_samples, tissue, stage, probes):
+class CombinationSimulator:
+    """
+    everything needed to simulate any batch of combinations on its own -
+    batch b covers combination ranks [b * batch_size, (b + 1) * batch_size) 
+    (or an explicit list of sampled combinations) and draws noise from an 
+    RNG seeded with (seed, b), so output doesn't depend on which process 
+    simulates which batch
+    """
+
+    def __init__(self, samples, matrix, k, with_replacement, tissue, stage, 
+                 model, seed, revolving_door=False, batch_size=BATCH_SIZE,
+                 precision=format_utils.PRECISION):
+        if revolving_door and with_replacement:
+            raise Exception('revolving door order only supports combinations ' +
+                            'without replacement')
+        self.samples = samples
+        self.matrix = matrix
+        self.k = k
+        self.with_replacement = with_replacement
+        self.tissue = tissue
+        self.stage = stage
+        self.model = model
+        self.seed = seed
+        self.revolving_door = revolving_door
+        self.batch_size = batch_size
+        self.precision = precision
+
+    def random_stream(self, *key):
+        """ independent, reproducible random stream for key under seed """
+        return np.random.SeedSequence(self.seed, spawn_key=key)
+
+    def simulate_batch(self, job):
+        """
+        simulate combinations for one batch job (batch id, first rank, count,
+        sampled combinations or None) and return formatted output lines plus 
+        dropout event counts
+        """
+        batch_id, start, count, batch = job
+        if batch == None and self.revolving_door:
+            batch, avg = revolving_door_means(self.matrix, self.k, start, count)
+        else:
+            if batch == None:
+                batch = list(combination_utils.iter_combinations(len(self.samples), 
+                                                                 self.k, 
+                                                                 self.with_replacement, 
+                                                                 start, count))
+            avg = combination_means(self.matrix, batch)
+        rng = np.random.default_rng(self.random_stream(NOISE_STREAM, batch_id))
+        sv_before = self.model.sv_dropouts
+        snp_before = self.model.snp_dropouts
+        vals = aggregate_probe_vals(avg, self.model, rng)
+        rows = format_utils.format_rows(vals, precision=self.precision)
+        lines = []
+        for combination, row in zip(batch, rows):
+            meta = combined_meta([self.samples[i] for i in combination], 
+                                 self.tissue, self.stage)
+            lines.append(meta + '\t' + row + '\n')
+        return (''.join(lines), 
+                self.model.sv_dropouts - sv_before,
+                self.model.snp_dropouts - snp_before)
+
+
+# simulator shared with forked worker processes (inherited, not pickled)
+_simulator = None
+
+def _simulate_batch(job):
+    return _simulator.simulate_batch(job)
+
+def make_combinations(simulator, out_file, max_samples, workers=1,
+                      random_sample=False, unique=False):
     """
     Make k unique combinations from samples up to max and print to out_file.
     Return number of combinations created. If max_samples is None, all possible
-    combinations will be created
+    combinations will be created. Combination ranks are split into batches 
+    that are simulated across worker processes and written in rank order.
+
+    If random_sample is set, max_samples combinations are instead drawn
+    uniformly at random (optionally without repeats) rather than taking the
+    first max_samples in order
     """
+    global _simulator
     
-    counter = 0
-    iterator = None
-    if with_replacement:
-        iterator = itertools.combinations_with_replacement(samples.values(), k)
-    else:
-        iterator = itertools.combinations(samples.values(), k)
-        
-    for combination in iterator:
-        if max_samples != None and counter >= max_samples:
-            break
+    n = len(simulator.samples)
+    total = combination_utils.count_combinations(n, simulator.k,
+                                                 simulator.with_replacement)
+    if max_samples != None:
+        total = min(total, max_samples)
+
+    sampled = None
+    if random_sample:
+        if max_samples == None:
+            raise Exception('max individuals required for random sampling')
+        total = max_samples
+        rng = np.random.default_rng(simulator.random_stream(SAMPLING_STREAM))
+        sampled = combination_utils.sample_combinations(n, simulator.k, total, 
+                                                        rng,
+                                                        simulator.with_replacement,
+                                                        unique=unique)
+
+    batch_size = simulator.batch_size
+    jobs = batch_jobs(total, batch_size, sampled)
+    pool = None
+    try:
+        if workers > 1:
+            _simulator = simulator
+            pool = multiprocessing.get_context('fork').Pool(workers)
+            results = matrix_utils.bounded_imap(pool, _simulate_batch, jobs,
+                                                workers * BATCHES_PER_WORKER)
         else:
-            combined = combine(combination, tissue, stage, probes)
-            print(combined, file=out_file)
-            counter += 1
+            results = map(simulator.simulate_batch, jobs)
+
+        counter = 0
+        for b, (text, sv_dropouts, snp_dropouts) in enumerate(results):
+            out_file.write(text)
+            counter += min(batch_size, total - b * batch_size)
+            if workers > 1:
+                # dropout counts happened in worker copies of the model
+                simulator.model.sv_dropouts += sv_dropouts
+                simulator.model.snp_dropouts += snp_dropouts
+    finally:
+        if pool != None:
+            pool.terminate()
+            pool.join()
     return counter
 
-def aggregate_probe_vals(samples, probes):
+def batch_jobs(total, batch_size, sampled=None):
     """
-    create probe vals that represent mean of each probe across samples
+    lazily yield (batch number, first rank, count, sampled combinations)
+    jobs covering ranks up to total - exhaustive runs can span billions of
+    combinations, so jobs are made as they are consumed
     """
-    probe_vals = {}
-    
-    for sample in samples:
-        # assume all samples have the same number of probes and use one at random
-        # as model
-        
-        for probe, val in sample.probe_vals.items():
-            if probe not in probe_vals:
-                probe_vals[probe] = 0      
-            probe_vals[probe] += val
-  
-    num_samples = len(samples)
-    
-    adjusted = {}
-    
-    # for each probe label
+    for b, start in enumerate(range(0, total, batch_size)):
+        count = min(batch_size, total - start)
+        batch = sampled[start:start + count] if sampled != None else None
+        yield b, start, count, batch
+
+def combination_means(matrix, batch):
+    """ mean of chosen sample rows of matrix for each combination in batch """
+    # sum in double precision - rows are single precision
+    return np.vstack([matrix[list(combination)].sum(axis=0, dtype=np.float64) / 
+                      len(combination) for combination in batch])
+
+def revolving_door_means(matrix, k, start, count):
+    """
+    means for count combinations starting at rank start in revolving door
+    order - consecutive combinations swap one sample, so the running probe
+    sum is updated with one subtract and one add instead of re-summing k
+    rows. Sum is rebuilt from scratch at the start of every batch, which 
+    bounds rounding drift
+    """
+    batch = []
+    avg = np.empty((count, matrix.shape[1]), dtype=np.float64)
+    total = None
+    walk = combination_utils.iter_revolving_door(len(matrix), k, start, count)
+    for i, (combination, removed, added) in enumerate(walk):
+        if total is None:
+            total = matrix[list(combination)].sum(axis=0, dtype=np.float64)
+        else:
+            total -= matrix[removed]
+            total += matrix[added]
+        avg[i] = total / k
+        batch.append(combination)
+    return batch, avg[:len(batch)]
+
+def aggregate_probe_vals(avg, model, rng):
+    """
+    create probe vals from mean of each probe across samples in each
+    combination (one row per combination)
+    """
+    # for each probe in noise model
         # randomly simulate sv
         # randomly simulate confounding snp
         # simulate random noise based off of stdev
         # adjust aggregate probe val accordingly
-    for probe_label, total_val in probe_vals.items():
-        avg = total_val / num_samples
-        if probe_label in probes:
-            probe = probes[probe_label]
-            
-            # negative values signal missing probe data in one or more
-            # samples used to create simulated sample -- skip adjustment
-            # in this case and print missing val (-1) for this probe
-            if avg > 0:
-                avg = simulation_noise.random_adjust(avg, probe)
-                adjusted[probe_label] = avg
-            else:
-                #FIXME: parameterize missing val
-                adjusted[probe_label] = -1
-        else:
-            adjusted[probe_label] = avg
-  
-    return adjusted
-
-def combine(samples, tissue, stage, probes):
-    """ make combined sample with methyl vals in samples"""
-    combined = m_utils.MethylSample()        
-    combined.case = 'sim'
-    combined.sample = '_'.join(set([s.case for s in samples]))
-    combined.biospecimen = 'mean-methyl-sim'
-    combined.tissue = tissue
-    combined.stage = stage
-    
-    print(f'creating simulated sample {combined.sample}', file=sys.stderr)
-    combined.probe_vals = aggregate_probe_vals(samples, probes)
+    # negative (or zero) means signal missing probe data in one or more
+    # samples used to create simulated sample -- skip adjustment in this 
+    # case and print missing val (-1) for this probe
+    return model.apply(avg, rng)
+
+def combined_meta(samples, tissue, stage):
+    """ metadata columns for combined sample made from samples """
+    # unique cases in order chosen so labels are reproducible
+    sample_label = '_'.join(dict.fromkeys([s.case for s in samples]))
+    print(f'creating simulated sample {sample_label}', file=sys.stderr)
+    print_vals = ['sim', sample_label, 'mean-methyl-sim', tissue]
  
     # samples should have same gender and age group, set synthetic sample
     # to be gender and mean of ages
     for sample in samples:
         if hasattr(sample, 'gender'):
-            combined.gender = sample.gender
-            combined.age = statistics.mean([s.age for s in samples])
+            age = statistics.mean([s.age for s in samples])
+            print_vals.extend([sample.gender, str(age), 
+                               m_utils.get_age_group(age), stage])
             break
-    return combined
+    return '\t'.join(print_vals)
 
 
 def main():
@@ -192,10 +346,10 @@ def main():
     
     # input files are rows = samples, cols = probe vals
     print(f'reading samples from {args.input}', file=sys.stderr)
-    samples = m_utils.load_file_as_samples(args.input, 
-                                           required=required, 
-                                           start_idx=args.probe_start_idx,
-                                           required_only=args.required_only)
+    samples, labels, matrix = m_utils.load_file_as_matrix(args.input, 
+                                                          required=required, 
+                                                          start_idx=args.probe_start_idx,
+                                                          required_only=args.required_only)
     print(f'{len(samples)} samples loaded', file=sys.stderr)
 
     probes = {}
@@ -222,7 +376,8 @@ def main():
 
     out_file = sys.stdout
     if args.output:
-        out_file = matrix_utils.open_output_file(args.output)
+        out_file = matrix_utils.open_output_file(args.output, blocked=args.bgzf,
+                                                 threads=args.compress_threads)
 
     include_meta = False
     header = matrix_utils.get_header_from_file(args.input,
@@ -235,15 +390,30 @@ def main():
     print(header, file=out_file)
     
   
-    counter = make_combinations(samples, 
-                                args.choose, 
-                                args.with_replacement,
+    seed = args.seed
+    if seed == None:
+        seed = np.random.SeedSequence().entropy
+    print(f'random seed: {seed}', file=sys.stderr)
+
+    model = simulation_noise.NoiseModel(probes, labels)
+    simulator = CombinationSimulator(samples,
+                                     matrix,
+                                     args.choose, 
+                                     args.with_replacement,
+                                     args.tissue,
+                                     args.stage,
+                                     model,
+                                     seed,
+                                     revolving_door=args.revolving_door,
+                                     precision=args.precision)
+    counter = make_combinations(simulator,
                                 out_file,
                                 args.max_individuals,
-                                args.tissue,
-                                args.stage,
-                                probes)
+                                workers=args.workers,
+                                random_sample=args.random_sample,
+                                unique=args.unique)
     out_file.close()
+    print(model.dropout_summary(), file=sys.stderr)
     print(f'{counter} simulated samples written', file=sys.stderr)
     print('completed', file=sys.stderr)
  
@@ -3,6 +3,7 @@ Collection of utilities for adding noise/confounding simulated methyl values
 """
 
 import matrix_utils
+import numpy as np
 import random
 import sys
 
@@ -125,7 +126,8 @@ def load_probe_stats(file, probes = None):
         for line in f:
             if line.startswith('probe'):
                 continue
-            label,f_min,f_max,f_mean,f_stdev = line.rstrip().split('\t')
+            # ignore any extra columns (missing count, quantiles) after stdev
+            label,f_min,f_max,f_mean,f_stdev = line.rstrip().split('\t')[:5]
 
             if label not in probes:
                 probes[label] = Probe(label)
@@ -133,6 +135,9 @@ def load_probe_stats(file, probes = None):
             probes[label].minimum = f_min
             probes[label].maximum = f_max
             probes[label].stdev = f_stdev
+            # older stats files hold nan stdev for probes with < 2 vals
+            if np.isnan(probes[label].stdev):
+                probes[label].stdev = 0.0
             
     return probes
 
@@ -320,3 +325,112 @@ def random_adjust(val, probe):
         
     return val
 
+
+
+# integer codes for variant types in compiled noise model
+VARIANT_TYPE_CODES = {'DEL': 1, 'DUP': 2, 'INV': 3, 'INS': 4}
+
+
+def compile_variants(probe_variants, attr):
+    """
+    flatten per-probe variant lists into CSR style arrays - variants for
+    probe i are entries offsets[i]:offsets[i+1] of freqs/types
+    """
+    offsets = np.zeros(len(probe_variants) + 1, dtype=np.int64)
+    freqs = []
+    types = []
+    for i, variants in enumerate(probe_variants):
+        offsets[i + 1] = offsets[i] + len(variants)
+        for variant in variants:
+            freqs.append(getattr(variant, attr))
+            types.append(VARIANT_TYPE_CODES.get(variant.type, 0))
+    return offsets, np.array(freqs, dtype=np.float64), np.array(types, dtype=np.int8)
+
+
+def draw_variant_hits(offsets, freqs, hit_mask, num_draws, rng):
+    """
+    draw every variant for num_draws simulated samples at once (variant is
+    present if uniform draw <= freq) and return (num_draws x probes) mask of
+    probes with at least one present variant that is also in hit_mask
+    """
+    num_probes = len(offsets) - 1
+    hits = np.zeros((num_draws, num_probes), dtype=bool)
+    if len(freqs) == 0:
+        return hits
+    present = (rng.random((num_draws, len(freqs))) <= freqs) & hit_mask
+
+    # or-reduce each probe's run of variants - empty runs are skipped
+    has_variants = np.flatnonzero(np.diff(offsets) > 0)
+    hits[:, has_variants] = np.logical_or.reduceat(present, offsets[has_variants], 
+                                                   axis=1)
+    return hits
+
+
+class NoiseModel:
+    """
+    noise/variant model compiled against a fixed probe order so whole rows
+    (or blocks of rows) of simulated probe vals can be adjusted with array 
+    operations. Structural variants and confounding snps are held as CSR 
+    style arrays (probe -> variant offsets, frequencies and type codes) so 
+    dropouts for a batch are a single vectorized Bernoulli draw
+    """
+
+    def __init__(self, probes, labels):
+        self.labels = labels
+        self.in_model = np.array([label in probes for label in labels], dtype=bool)
+
+        # probes without stats get no noise, same as get_probe_noise
+        self.stdev = np.zeros(len(labels), dtype=np.float64)
+        for i, label in enumerate(labels):
+            if label in probes and probes[label].stdev != None:
+                self.stdev[i] = probes[label].stdev
+
+        empty = []
+        svs = [probes[label].svs if label in probes else empty for label in labels]
+        snps = [probes[label].snps if label in probes else empty for label in labels]
+
+        # only homozygous deletions cause sv dropout
+        self.sv_offsets, self.sv_freqs, self.sv_types = compile_variants(svs, 'hom_freq')
+        self.sv_dropout_types = self.sv_types == VARIANT_TYPE_CODES['DEL']
+        self.snp_offsets, self.snp_freqs, _ = compile_variants(snps, 'freq')
+
+        # aggregate dropout event counts over all calls to apply
+        self.sv_dropouts = 0
+        self.snp_dropouts = 0
+
+    def apply(self, vals, rng, adjust_zero=False, missing=-1.0):
+        """
+        vectorized random_adjust over a row or (samples x probes) block of 
+        probe vals - probes in the model with a missing (negative) val, or 
+        zero unless adjust_zero is set, get the missing val instead of being
+        adjusted
+        """
+        adjusted = np.array(vals, dtype=np.float64)
+        block = np.atleast_2d(adjusted)
+        if adjust_zero:
+            adjust = self.in_model & (block >= 0)
+        else:
+            adjust = self.in_model & (block > 0)
+        block[self.in_model & ~adjust] = missing
+
+        noise = rng.uniform(-self.stdev, self.stdev, size=block.shape)
+        block[adjust] = np.maximum(block[adjust] + noise[adjust], 0)
+
+        # drop probe val entirely if we have random hom. deletion or
+        # confounding snp - snps only checked if sv didn't already drop it
+        signal = adjust & (block > 0)
+        sv_hits = draw_variant_hits(self.sv_offsets, self.sv_freqs, 
+                                    self.sv_dropout_types, len(block), rng)
+        snp_hits = draw_variant_hits(self.snp_offsets, self.snp_freqs, True,
+                                     len(block), rng)
+        sv_dropout = signal & sv_hits
+        snp_dropout = signal & snp_hits & ~sv_dropout
+        block[sv_dropout | snp_dropout] = 0
+
+        self.sv_dropouts += int(sv_dropout.sum())
+        self.snp_dropouts += int(snp_dropout.sum())
+        return adjusted
+
+    def dropout_summary(self):
+        return (f'{self.sv_dropouts} probe vals zeroed by structural variants, ' +
+                f'{self.snp_dropouts} by confounding snps')
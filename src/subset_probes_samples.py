@@ -4,7 +4,17 @@
 
 import sys
 import argparse
+import itertools
+import numpy as np
 import matrix_utils
+import matrix_index
+import matrix_store
+import format_utils
+
+TAB = ord('\t')
+
+# store rows projected at once
+STORE_CHUNK = 256
 
 def parse_args():
     parser = argparse.ArgumentParser(description='extract methylation values ' +
@@ -28,6 +38,13 @@ def parse_args():
                         help='tolerate missing probes')
     
     
+    parser.add_argument('--bgzf', action='store_true',
+                        help='write gzipped output as seekable block gzip (BGZF)')
+
+    parser.add_argument('--compress_threads', type=int, default=1,
+                        help='threads compressing gzipped output in the ' +
+                        'background [default=1]')
+
     args = parser.parse_args()
     
     return args
@@ -47,6 +64,79 @@ def load_file(file):
             vals.add(fields[0])
     return vals
 
+def field_bounds(data):
+    """ start and end offsets of every tab delimited field in bytes """
+    tabs = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == TAB)
+    starts = np.empty(len(tabs) + 1, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = tabs + 1
+    ends = np.append(tabs, len(data))
+    return starts, ends
+
+def project_line(line, cols):
+    """
+    pick cols out of tab delimited line - tabs are located with one bulk
+    byte scan so only the requested fields are ever sliced out, instead of 
+    splitting every field into its own string
+    """
+    data = line.encode()
+    starts, ends = field_bounds(data)
+    return b'\t'.join([data[start:end] for start, end 
+                       in zip(starts[cols].tolist(), ends[cols].tolist())]).decode()
+
+def select_columns(header, probes, probe_start_idx, lenient):
+    """
+    indexes of metadata columns plus columns in probe subset (all if None),
+    in header order
+    """
+    probe_idxs = []
+    found_probes = set()
+    for i in range(0, len(header)):
+        # keep metadata columns of sample info no matter what as 
+        # well as cols in our probe subset
+        if probes == None or i < probe_start_idx or header[i] in probes:
+            probe_idxs.append(i)
+            found_probes.add(header[i])
+        
+    # make sure we got all probes
+    if probes != None:
+        for probe in probes:
+            if not probe in found_probes:
+                msg = "probe not found in header: " + probe
+                if lenient:
+                    print(msg, file=sys.stderr)
+                else:
+                    raise Exception(msg)
+    return probe_idxs
+
+def subset_store(file, samples, probes, probe_start_idx, lenient, output):
+    """
+    read only requested rows and probe columns of binary store - returns
+    number of sample rows written
+    """
+    store = matrix_store.MatrixStore(file)
+    if probe_start_idx != store.probe_start_idx:
+        raise Exception(f'probe start index {probe_start_idx} does not match ' +
+                        f'store: {store.probe_start_idx}')
+    header = store.header
+    probe_idxs = select_columns(header, probes, probe_start_idx, lenient)
+    print('\t'.join([header[i] for i in probe_idxs]), file=output)
+    meta_cols = [i for i in probe_idxs if i < probe_start_idx]
+    probe_cols = [i - probe_start_idx for i in probe_idxs if i >= probe_start_idx]
+
+    rows = np.arange(len(store))
+    if samples != None:
+        sample_idx = store.meta_columns.index('sample') if 'sample' in store.meta_columns else 1
+        rows = np.flatnonzero(np.isin(store.meta[:, sample_idx], list(samples)))
+
+    for start in range(0, len(rows), STORE_CHUNK):
+        chunk = rows[start:start + STORE_CHUNK]
+        block = store.matrix[np.ix_(chunk, probe_cols)]
+        formatted = format_utils.format_rows(block, na='NA')
+        for meta, vals in zip(store.meta[chunk][:, meta_cols].tolist(), formatted):
+            print('\t'.join(meta + [vals] if probe_cols else meta), file=output)
+    return len(rows)
+
 def main():
     args = parse_args()
     
@@ -54,7 +144,7 @@ def main():
     probes = None
     
     if args.samples:
-        print(f'reading samples from: {args.probes}', file=sys.stderr)
+        print(f'reading samples from: {args.samples}', file=sys.stderr)
         samples = load_file(args.samples)
         print(f'{len(samples)} samples loaded', file=sys.stderr)
          
@@ -66,55 +156,50 @@ def main():
     output = sys.stdout
     if args.output:
         print(f'writing to output file: {args.output}', file=sys.stderr)
-        output = matrix_utils.open_output_file(args.output)
-    
-    probe_idxs = []
-    found_probes = set()
-    header = True
+        output = matrix_utils.open_output_file(args.output, blocked=args.bgzf,
+                                               threads=args.compress_threads)
     
     print(f'reading from input file: {args.input}', file=sys.stderr)
-    f = matrix_utils.open_file(args.input)
-    
-    counter = 0
+    if matrix_store.is_store(args.input):
+        counter = subset_store(args.input, samples, probes, args.probe_start_idx,
+                               args.lenient, output)
+        output.close()
+        print(f'{counter} lines written...completed', file=sys.stderr)
+        return
+
+    # with a row index available, only visit header and requested sample rows
+    index = matrix_index.load_index(args.input) if samples != None else None
+    f = matrix_utils.open_file(args.input, threads=1 if index != None else
+                               matrix_utils.DECOMPRESS_THREADS)
+    lines = f
+    if index != None:
+        print(f'using row index for sample lookup', file=sys.stderr)
+        lines = itertools.chain([f.readline()], 
+                                index.read_rows(index.rows_for(samples, by='sample')))
+    
+    # read column headers and identify column indexes for probe subset
+    header = next(lines).rstrip().split('\t')
+    probe_idxs = select_columns(header, probes, args.probe_start_idx, args.lenient)
+    cols = np.array(probe_idxs, dtype=np.int64)
+    print('\t'.join([header[i] for i in probe_idxs]), file=output)
+
     # default to sample index of 1
-    sample_idx = 1
-    for line in f:
+    sample_idx = header.index('sample') if 'sample' in header else 1
+    
+    counter = 1
+    for line in lines:
         counter += 1
         if counter % 10000 == 0:
             print(f'{counter} lines read from input', file=sys.stderr)
         
-        fields = line.rstrip().split('\t')
-        if header:
-            # read column headers and identify column indexes for probe subset
-            for i in range(0, len(fields)):
-
-                if fields[i] == 'sample':
-                    sample_idx = i
-                
-                # keep metadata columns of sample info no matter what as 
-                # well as cols in our probe subset
-                if probes == None or i < args.probe_start_idx or fields[i] in probes:
-                    probe_idxs.append(i)
-                    found_probes.add(fields[i])
-                
-            # make sure we got all probes
-            if probes != None:
-                for probe in probes:
-                    if not probe in found_probes:
-                        msg = "probe not found in header: " + probe
-                        if args.lenient:
-                            print(msg, file=sys.stderr)
-                        else:
-                            raise Exception(msg)
-            
-            header = False
-        
-        vals = []
+        line = line.rstrip()
         # filter by samples if requested
-        if samples == None or fields[sample_idx] in samples:
-            for idx in probe_idxs:
-                vals.append(fields[idx])
-            print('\t'.join(vals), file=output)
+        if samples != None and line.split('\t', sample_idx + 1)[sample_idx] not in samples:
+            continue
+        if probes == None:
+            print(line, file=output)
+        else:
+            print(project_line(line, cols), file=output)
     
     output.close()
     f.close()    
@@ -122,4 +207,4 @@ def main():
     print(f'{counter} lines written...completed', file=sys.stderr)
 
 if __name__ == "__main__":
-    main()    
+    main()
@@ -0,0 +1,85 @@
+"""
+Out-of-core transpose of 'long' probe tables (probes as rows, samples as
+columns) into sample rows.
+
+Probe rows are parsed into a float32 block until the memory budget is used
+up, then the block is spilled to a temp file sample-major (each sample's vals
+for the block's probes stored contiguously). Once every probe has been added,
+sample rows are put back together a chunk of samples at a time by reading
+that chunk's slice out of each spilled block, so memory stays bounded by the
+budget rather than the size of the table.
+"""
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# default memory budget for probe blocks and sample chunks
+MEMORY_MB = 1024
+
+BYTES_PER_VAL = np.dtype(np.float32).itemsize
+
+
+class ProbeTransposer:
+    """ collects probe rows in bounded memory and reads back sample rows """
+
+    def __init__(self, num_samples, memory_mb=MEMORY_MB, temp_dir=None):
+        self.num_samples = num_samples
+        self.budget = int(memory_mb * 1024 * 1024)
+        self.block_probes = max(1, self.budget // (BYTES_PER_VAL * max(1, num_samples)))
+        self.block = np.empty((self.block_probes, num_samples), dtype=np.float32)
+        self.filled = 0
+        self.num_probes = 0
+        self.spilled = []
+        self.temp_dir = tempfile.mkdtemp(prefix='heisenberg_transpose_',
+                                         dir=temp_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_probe(self, vals):
+        """ add vals (one per sample, NaN for missing) for the next probe """
+        self.block[self.filled] = vals
+        self.filled += 1
+        self.num_probes += 1
+        if self.filled == self.block_probes:
+            self._spill()
+
+    def _spill(self):
+        """ write filled part of block to temp file as samples x probes """
+        if self.filled == 0:
+            return
+        path = os.path.join(self.temp_dir, f'block_{len(self.spilled)}.f32')
+        np.ascontiguousarray(self.block[:self.filled].T).tofile(path)
+        self.spilled.append((path, self.filled))
+        self.filled = 0
+
+    def sample_chunks(self):
+        """
+        yield (first sample, samples x probes array) chunks of sample rows
+        in sample order, each chunk sized to fit the memory budget
+        """
+        self._spill()
+        self.block = None
+        blocks = [np.memmap(path, dtype=np.float32, mode='r',
+                            shape=(self.num_samples, num_probes))
+                  for path, num_probes in self.spilled]
+        row_bytes = BYTES_PER_VAL * max(1, self.num_probes)
+        chunk_size = max(1, self.budget // row_bytes)
+        for start in range(0, self.num_samples, chunk_size):
+            end = min(start + chunk_size, self.num_samples)
+            chunk = np.empty((end - start, self.num_probes), dtype=np.float32)
+            col = 0
+            for block in blocks:
+                chunk[:, col:col + block.shape[1]] = block[start:end]
+                col += block.shape[1]
+            yield start, chunk
+        del blocks
+
+    def close(self):
+        """ remove spilled blocks """
+        shutil.rmtree(self.temp_dir, ignore_errors=True)